@@ -0,0 +1,211 @@
+"""Benchmarks for the Bugs module against the local ReplayServer.
+
+Run from the OrpheusDL directory, so the module can import utils.models:
+
+    python -m modules.bugs.benchmarks.bench_bugs --latency 0.05 --json bench_output.txt
+
+Every scenario reports the number of HTTP requests and multi invoke calls, the wall time and the peak Python memory
+(tracemalloc, measured in a second run so it does not slow down the timed run).
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from .replay_server import ReplayServer, SyntheticCatalog
+
+
+class TemporarySettings:
+    # in-memory version of the OrpheusDL temporary settings controller
+    def __init__(self, values: dict = None):
+        self.values = dict(values or {})
+
+    def read(self, key: str):
+        return self.values.get(key)
+
+    def set(self, key: str, value):
+        self.values[key] = value
+
+
+class BenchmarkModuleError(Exception):
+    pass
+
+
+def create_module(server: ReplayServer, settings: dict = None):
+    from ..interface import ModuleInterface
+
+    # a valid session with cached account rights, so the benchmarks only measure the metadata requests
+    temporary_settings = TemporarySettings({
+        'device_id': 'benchmark',
+        'access_token': 'token',
+        'refresh_token': 'refresh',
+        'expires': datetime.now() + timedelta(hours=1),
+        'account_rights': {'flac_premium': True, 'streaming': True, 'checked': datetime.now()},
+    })
+
+    module_controller = SimpleNamespace(
+        module_settings={'metadata_cache': False, **(settings or {})},
+        data_folder=tempfile.mkdtemp(prefix='bugs_benchmark_'),
+        temporary_settings_controller=temporary_settings,
+        module_error=BenchmarkModuleError,
+        printer_controller=SimpleNamespace(oprint=print),
+        orpheus_options=SimpleNamespace(default_cover_options=SimpleNamespace(resolution=1400)),
+    )
+
+    module = ModuleInterface(module_controller)
+    server.attach(module.session)
+    return module
+
+
+def album_info(module, catalog: SyntheticCatalog):
+    for album_id in catalog.albums:
+        module.get_album_info(album_id)
+
+
+def artist_info(module, catalog: SyntheticCatalog):
+    for artist_id in catalog.artists:
+        module.get_artist_info(artist_id, get_credited_albums=True)
+
+
+def search(module, catalog: SyntheticCatalog):
+    from utils.models import DownloadTypeEnum
+
+    for query_type in (DownloadTypeEnum.track, DownloadTypeEnum.album, DownloadTypeEnum.artist):
+        module.search(query_type, 'Track 0-1' if query_type is DownloadTypeEnum.track else '0', limit=20)
+
+
+def track_resolution(module, catalog: SyntheticCatalog):
+    # the same calls OrpheusDL makes for an album download
+    from utils.models import QualityEnum
+
+    cover_options = SimpleNamespace(resolution=1400)
+    for album_id in catalog.albums:
+        album = module.get_album_info(album_id)
+        for track_id in album.tracks:
+            track = module.get_track_info(track_id, QualityEnum.LOSSLESS, None, **album.track_extra_kwargs)
+            module.get_track_cover(track_id, cover_options, **album.track_extra_kwargs)
+            module.get_track_lyrics(track_id)
+            module.get_track_download(**track.download_extra_kwargs)
+
+
+def manifest(module, catalog: SyntheticCatalog):
+    from utils.models import QualityEnum
+
+    # every track as its own url plus every album url, written to a new manifest
+    urls = [f'https://music.bugs.co.kr/track/{t}' for t in catalog.tracks]
+    urls += [f'https://music.bugs.co.kr/album/{a}' for a in catalog.albums]
+    module.resolve_manifest(urls, os.path.join(module.module_controller.data_folder, 'manifest.jsonl'),
+                            QualityEnum.LOSSLESS)
+
+
+def artist_tracks_decoded(module, catalog: SyntheticCatalog):
+    # the whole discography in one response, decoded at once and projected to records afterwards
+    from ..records import TrackRecord
+
+    for artist_id in catalog.artists:
+        tracks = module.session.get_artist_tracks(artist_id)[0].get('artist_track').get('list')
+        [TrackRecord.from_api(t) for t in tracks]
+
+
+def artist_tracks_streamed(module, catalog: SyntheticCatalog):
+    # the same response decoded incrementally, every track is projected while the rest is still received
+    from ..records import TrackRecord
+
+    for artist_id in catalog.artists:
+        [TrackRecord.from_api(t) for t in module.session.stream_artist_tracks(artist_id)]
+
+
+def album_resync(module, catalog: SyntheticCatalog):
+    # a full pass over all albums with the metadata cache, then a second pass which revalidates every response like a
+    # nightly re-sync, run with --validators to answer the second pass with 304s
+    from ..cache import ResponseCache, SingleFlightLRU
+
+    module.prefetch_track_data = False
+    module.session.cache = ResponseCache(os.path.join(module.module_controller.data_folder, 'metadata_cache.db'))
+    for cache_bypass in (False, True):
+        module.session.cache_bypass = cache_bypass
+        module.albums = SingleFlightLRU(maxsize=module.albums.maxsize)
+        for album_id in catalog.albums:
+            module.get_album_info(album_id)
+
+
+scenarios = {
+    'album_info': (album_info, [(1, 10), (1, 50), (1, 200)]),
+    'artist_info': (artist_info, [(10, 10), (50, 12), (200, 12)]),
+    'search': (search, [(10, 12)]),
+    'track_resolution': (track_resolution, [(1, 10), (1, 50), (5, 12)]),
+    'manifest': (manifest, [(10, 12), (100, 12)]),
+    'artist_tracks_decoded': (artist_tracks_decoded, [(100, 12), (400, 25)]),
+    'artist_tracks_streamed': (artist_tracks_streamed, [(100, 12), (400, 25)]),
+    'album_resync': (album_resync, [(50, 12)]),
+}
+
+
+def measure(scenario, catalog: SyntheticCatalog, server: ReplayServer, settings: dict = None):
+    server.reset_stats()
+    module = create_module(server, settings)
+    start = time.perf_counter()
+    scenario(module, catalog)
+    # background prefetches belong to the scenario and must not outlive the server
+    module.executor.shutdown(wait=True)
+    module.lyrics_executor.shutdown(wait=True)
+    wall_time = time.perf_counter() - start
+    stats = dict(server.stats)
+
+    # second run with a new module, only for the memory usage
+    module = create_module(server, settings)
+    tracemalloc.start()
+    scenario(module, catalog)
+    module.executor.shutdown(wait=True)
+    module.lyrics_executor.shutdown(wait=True)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'requests': stats.get('requests', 0),
+        'invoke_calls': stats.get('invoke_calls', 0),
+        'response_bytes': stats.get('response_bytes', 0),
+        'wall_time': round(wall_time, 4),
+        'peak_memory': peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bugs module benchmarks against a local replay server')
+    parser.add_argument('--scenario', action='append', choices=list(scenarios), help='run only these scenarios')
+    parser.add_argument('--latency', type=float, default=0.0, help='injected latency per request in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random additional latency in seconds')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--rate-5xx', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--validators', action='store_true', help='send ETags and answer matching requests with 304')
+    parser.add_argument('--compression', action='store_true', help='gzip the responses')
+    parser.add_argument('--json', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = []
+    for name in args.scenario or scenarios:
+        scenario, sizes = scenarios[name]
+        for albums, tracks in sizes:
+            catalog = SyntheticCatalog(artists=1, albums_per_artist=albums, tracks_per_album=tracks)
+            with ReplayServer(catalog, latency=args.latency, jitter=args.jitter, rate_429=args.rate_429,
+                              rate_5xx=args.rate_5xx, validators=args.validators,
+                              compression=args.compression) as server:
+                result = {'scenario': name, 'albums': albums, 'tracks': albums * tracks,
+                          **measure(scenario, catalog, server)}
+
+            results.append(result)
+            print(f'{name:<18} {albums:>4} albums {albums * tracks:>6} tracks: {result["requests"]:>6} requests '
+                  f'{result["invoke_calls"]:>6} calls {result["wall_time"]:>8.3f}s '
+                  f'{result["peak_memory"] / 1024 / 1024:>8.2f} MiB')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+import gzip
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+def call_key(call_id: str, args: dict) -> str:
+    return json.dumps([call_id, args], sort_keys=True, separators=(',', ':'))
+
+
+def request_key(method: str, path: str, params: dict) -> str:
+    # the device_id changes between runs and does not change the response
+    params = sorted((k, str(v)) for k, v in params.items() if k != 'device_id')
+    return json.dumps([method, path, params], separators=(',', ':'))
+
+
+class Recordings:
+    # responses recorded from mapi.bugs.co.kr/secure.bugs.co.kr, multi invoke responses are stored per call, so
+    # the calls can be replayed in any combination
+    def __init__(self, calls: dict = None, requests: dict = None):
+        self.calls = calls or {}
+        self.requests = requests or {}
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data.get('calls'), data.get('requests'))
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'calls': self.calls, 'requests': self.requests}, f, ensure_ascii=False)
+
+    def invoke(self, call_id: str, args: dict):
+        return self.calls.get(call_key(call_id, args))
+
+    def request(self, method: str, path: str, params: dict):
+        return self.requests.get(request_key(method, path, params))
+
+
+class Recorder:
+    # records every response of a BugsApi session, e.g.
+    #   recorder = Recorder(bugs_api)
+    #   ... use bugs_api ...
+    #   recorder.recordings.save('recordings.json')
+    def __init__(self, api):
+        self.recordings = Recordings()
+        self._lock = threading.Lock()
+        api.s.hooks['response'].append(self._record)
+
+    def _record(self, r, *args, **kwargs):
+        if r.status_code != 200:
+            return
+
+        url = urlsplit(r.request.url)
+        params = dict(parse_qsl(url.query))
+        body = r.json()
+
+        with self._lock:
+            if url.path.endswith('multi/invoke/map'):
+                calls = json.loads(r.request.body)
+                for call, result in zip(calls, body.get('list') or []):
+                    self.recordings.calls[call_key(call['id'], call['args'])] = result
+            else:
+                self.recordings.requests[request_key(r.request.method, url.path, params)] = body
+
+
+class SyntheticCatalog:
+    # generated artists, albums and tracks with all fields the module reads, used for the benchmarks at different
+    # album/discography sizes
+    def __init__(self, artists: int = 1, albums_per_artist: int = 10, tracks_per_album: int = 12, seed: int = 0):
+        rnd = random.Random(seed)
+        self.artists, self.albums, self.tracks = {}, {}, {}
+        self.artist_albums, self.artist_tracks, self.album_tracks = {}, {}, {}
+
+        track_id, album_id = 1000000, 100000
+        for a in range(artists):
+            artist_id = 10000 + a
+            artist = {'artist_id': artist_id, 'artist_nm': f'Artist {a}'}
+            self.artists[artist_id] = dict(artist, image={'path': f'/{artist_id}.jpg'})
+            self.artist_albums[artist_id], self.artist_tracks[artist_id] = [], []
+
+            for b in range(albums_per_artist):
+                album_id += 1
+                album = {
+                    'album_id': album_id,
+                    'title': f'Album {a}-{b}',
+                    'release_ymd': f'{2000 + b % 24}{rnd.randint(1, 12):02d}{rnd.randint(1, 28):02d}',
+                    'artists': [artist],
+                    'track_count': tracks_per_album,
+                    'disc_count': 1,
+                    'genres': [{'svc_nm': 'K-Pop'}],
+                    'labels': [{'label_nm': f'Label {a}'}],
+                    'image': {'path': f'/{album_id // 100}/{album_id}.jpg'},
+                    'live_image': {},
+                }
+                self.albums[album_id] = album
+                self.artist_albums[artist_id].append(album)
+                self.album_tracks[album_id] = []
+
+                for t in range(tracks_per_album):
+                    track_id += 1
+                    self.tracks[track_id] = {
+                        'track_id': track_id,
+                        'track_title': f'Track {a}-{b}-{t}',
+                        'album': {k: album[k] for k in ('album_id', 'title', 'release_ymd', 'image')},
+                        'artists': [artist],
+                        'rights': {
+                            'streaming': {'service_yn': True, 'flac_premium_yn': rnd.random() < 0.3},
+                            'download_flac': {'service_flac_yn': True},
+                        },
+                        'bitrates': ['flac', 'aac256', '320k', 'aac'] + (['flac24'] if rnd.random() < 0.2 else []),
+                        'len': f'{rnd.randint(2, 5):02d}:{rnd.randint(0, 59):02d}',
+                        'track_no': t + 1,
+                        'disc_no': 1,
+                        'track_gain': round(rnd.uniform(-10, 0), 2),
+                    }
+                    self.artist_tracks[artist_id].append(self.tracks[track_id])
+                    self.album_tracks[album_id].append(self.tracks[track_id])
+
+    @staticmethod
+    def _page(items: list, args: dict):
+        page, size = int(args.get('page', 1)), int(args.get('size', 20))
+        return {'list': items[(page - 1) * size:page * size], 'pager': {'page': page, 'total_count': len(items)}}
+
+    def invoke(self, call_id: str, args: dict):
+        if call_id == 'track':
+            result = {'result': self.tracks.get(args['track_id'])}
+        elif call_id == 'album':
+            result = {'result': self.albums.get(args['album_id'])}
+        elif call_id == 'album_track':
+            result = {'list': self.album_tracks.get(args['album_id'], [])}
+        elif call_id == 'artist':
+            result = {'result': self.artists.get(args['artist_id'])}
+        elif call_id == 'artist_image':
+            artist = self.artists.get(args['artist_id'])
+            result = {'list': [artist['image']] if artist else []}
+        elif call_id == 'artist_track':
+            result = self._page(self.artist_tracks.get(args['artist_id'], []), args)
+        elif call_id == 'artist_album_filter_release':
+            albums = sorted(self.artist_albums.get(args['artist_id'], []), key=lambda a: a['release_ymd'],
+                            reverse=True)
+            result = self._page(albums, args)
+        elif call_id in {'artist_album_filter_joincompil', 'artist_mv', 'album_image'}:
+            result = self._page([], args)
+        elif call_id in {'track_artist_role', 'album_artist_role'}:
+            result = {'list': []}
+        elif call_id == 'get_search_combine':
+            result = {'result': {}}
+            for category in ('track', 'album', 'artist'):
+                result['result'].update(self._search(args['query'], category, 1, 20))
+        else:
+            return None
+
+        return {call_id: dict(result, ret_code=0)}
+
+    def _search(self, query: str, category: str, page: int, size: int):
+        # every word of the query has to be in the name or the artist name
+        words = set(re.findall(r'\w+', query.lower()))
+
+        def matches(*texts):
+            return words <= set(re.findall(r'\w+', ' '.join(texts).lower()))
+
+        if category == 'track':
+            items = [t for t in self.tracks.values() if matches(t['track_title'], t['artists'][0]['artist_nm'])]
+        elif category == 'album':
+            items = [a for a in self.albums.values() if matches(a['title'], a['artists'][0]['artist_nm'])]
+        else:
+            items = [a for a in self.artists.values() if matches(a['artist_nm'])]
+
+        return {category: self._page(items, {'page': page, 'size': size})}
+
+    def request(self, method: str, path: str, params: dict):
+        parts = path.strip('/').split('/')
+        if path.endswith('/lyrics'):
+            lines = '＃'.join(f'{i * 3.5:.2f}|Line {i}' for i in range(40))
+            return {'ret_code': 0, 'result': {'time': lines}}
+        elif path.endswith('/streaming'):
+            return {'ret_code': 0, 'result': {'state': 'OK', 'url': f'https://example.invalid/{parts[-2]}.flac'}}
+        elif len(parts) >= 4 and parts[-2] == 'search':
+            result = self._search(params.get('query', ''), parts[-1], int(params.get('page', 1)),
+                                  int(params.get('size', 20)))
+            return dict(result[parts[-1]], ret_code=0)
+        elif path.endswith('/right'):
+            return {'ret_code': 0, 'result': {'stream': {'is_premium': True, 'is_flac_premium': True}}}
+        elif path.endswith('/login') or path.endswith('/token/refresh'):
+            return {'ret_code': 0, 'result': {'token': {'access_token': 'token', 'refresh_token': 'refresh',
+                                                        'expires_in': 3600}}}
+        return None
+
+
+class ReplayServer:
+    # local stand-in for mapi.bugs.co.kr and secure.bugs.co.kr, point BugsApi.api_url and BugsApi.secure_url to
+    # server.api_url and server.secure_url; latency and 429/5xx responses can be injected. With validators every
+    # response gets an ETag and a matching If-None-Match is answered with 304, with compression bodies are gzipped
+    def __init__(self, backend, latency: float = 0.0, jitter: float = 0.0, rate_429: float = 0.0,
+                 rate_5xx: float = 0.0, seed: int = 0, validators: bool = False, compression: bool = False):
+        self.backend = backend
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.validators = validators
+        self.compression = compression
+
+        self.stats = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    @property
+    def api_url(self):
+        return f'{self.base_url}/music/5/'
+
+    @property
+    def secure_url(self):
+        return f'{self.base_url}/api/5/'
+
+    def attach(self, api):
+        # points a BugsApi to this server
+        api.api_url = self.api_url
+        api.secure_url = self.secure_url
+        return api
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='ReplayServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _inject(self):
+        # returns the injected status code or None
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.rate_429:
+            return 429
+        if roll < self.rate_429 + self.rate_5xx:
+            return 503
+        return None
+
+    def _respond(self, method: str, raw_path: str, body: bytes):
+        url = urlsplit(raw_path)
+        params = dict(parse_qsl(url.query))
+
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['request_bytes'] += len(body)
+
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._random.uniform(0, self.jitter))
+
+        status = self._inject()
+        if status:
+            with self._lock:
+                self.stats[f'status_{status}'] += 1
+            return status, {'ret_code': status, 'ret_msg': 'injected error'}
+
+        if url.path.endswith('multi/invoke/map'):
+            calls = json.loads(body or b'[]')
+            with self._lock:
+                self.stats['invoke_calls'] += len(calls)
+                for call in calls:
+                    self.stats[f'call:{call["id"]}'] += 1
+
+            results = [self.backend.invoke(call['id'], call['args']) for call in calls]
+            if any(r is None for r in results):
+                return 404, {'ret_code': 404, 'ret_msg': 'call not recorded'}
+            return 200, {'ret_code': 0, 'list': results}
+
+        with self._lock:
+            self.stats[f'path:{"/".join(p for p in url.path.split("/") if not p.isdigit())}'] += 1
+
+        result = self.backend.request(method, url.path, params)
+        if result is None:
+            return 404, {'ret_code': 404, 'ret_msg': 'request not recorded'}
+        return 200, result
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, without this every response waits for the delayed ACK
+            disable_nagle_algorithm = True
+
+            def _handle(self, method: str):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                status, result = server._respond(method, self.path, body)
+
+                data = json.dumps(result, ensure_ascii=False).encode()
+                headers = {'Content-Type': 'application/json'}
+
+                if server.validators and status == 200:
+                    headers['ETag'] = f'"{hashlib.sha1(data).hexdigest()}"'
+                    if self.headers.get('If-None-Match') == headers['ETag']:
+                        status, data = 304, b''
+                if server.compression and data and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                    data = gzip.compress(data, compresslevel=6)
+                    headers['Content-Encoding'] = 'gzip'
+                if status == 429:
+                    headers['Retry-After'] = '0'
+
+                with server._lock:
+                    server.stats['response_bytes'] += len(data)
+                    if status == 304:
+                        server.stats['status_304'] += 1
+
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if status != 304:
+                    self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -1,37 +1,195 @@
+import re
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from json import dumps, loads
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3 import Retry
+from urllib3.connection import HTTPConnection
+
+from .cache import ResponseCache
+from .metrics import Metrics
+from .resilience import AdaptiveRateLimiter, CircuitBreaker, parse_retry_after
+from .streaming import iter_list_items
+
+_ret_code = re.compile(r'"ret_code"\s*:\s*(-?\d+)\s*}\s*$')
+
+
+def _brotli_supported() -> bool:
+    # urllib3 decodes "br" responses if one of the brotli packages is installed
+    for name in ('brotli', 'brotlicffi'):
+        try:
+            __import__(name)
+            return True
+        except ImportError:
+            pass
+    return False
+
+
+accept_encoding = 'br, gzip' if _brotli_supported() else 'gzip'
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    # HTTPAdapter which can enable TCP keep-alive on its pooled connections
+    def __init__(self, keep_alive: bool = True, **kwargs):
+        self.keep_alive = keep_alive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive:
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
 
 
 class BugsApi:
-    def __init__(self):
+    # every host gets its own connection pool, so image downloads do not take connections from API calls
+    pool_hosts = ['https://mapi.bugs.co.kr', 'https://secure.bugs.co.kr', 'https://image.bugsm.co.kr']
+
+    def __init__(self, pool_maxsize: int = 32, pool_block: bool = False, keep_alive: bool = True):
         # device id from the Bugs android app
         self.device_id = None
 
-        # all required session variables
+        # all required session variables, only changed together while holding _token_lock
         self.access_token = None
         self.refresh_token = None
         self.expires = None
+        self._token_lock = threading.RLock()
+        # only one thread logs in or refreshes the token at the same time
+        self._auth_lock = threading.Lock()
+
+        # base urls, can be pointed to a local server
+        self.api_url = 'https://mapi.bugs.co.kr/music/5/'
+        self.secure_url = 'https://secure.bugs.co.kr/api/5/'
 
         self.s = requests.Session()
+        self.configure_pools(pool_maxsize, pool_block, keep_alive)
 
-        retries = Retry(total=10,
-                        backoff_factor=0.4,
-                        status_forcelist=[429, 500, 502, 503, 504])
+        # (connect, read) timeouts in seconds per endpoint class
+        self.timeouts = {
+            'metadata': (5, 20),
+            'stream': (5, 10),
+            'auth': (5, 20),
+        }
 
-        self.s.mount('http://', HTTPAdapter(max_retries=retries))
-        self.s.mount('https://', HTTPAdapter(max_retries=retries))
+        # retries for 429 and 5xx responses, the backoff is capped at max_backoff seconds
+        self.max_retries = 5
+        self.backoff_factor = 0.4
+        self.max_backoff = 30
+        self.retry_statuses = {429, 500, 502, 503, 504}
+
+        # shared by all threads using this client, can also be shared between clients
+        self.rate_limiter = AdaptiveRateLimiter()
+        self.circuit_breaker = CircuitBreaker()
+
+        # coalesces single lookups from many callers into one multi/invoke/map request
+        self.batcher = MultiInvokeBatcher(self)
+
+        # optional ResponseCache for metadata responses, cache_bypass skips the lookup but still stores the response
+        self.cache = None
+        self.cache_bypass = False
+
+        # list responses of the stream_* methods which are larger than this are decoded while they are received
+        self.stream_threshold = 256 * 1024
+        self.stream_chunk_size = 64 * 1024
+
+        # optional Metrics, None disables all instrumentation
+        self.metrics = None
+
+        # the access_token is refreshed this long before it expires, or if the API rejects it with a 401.
+        # token_refresher replaces refresh() for that, e.g. to fall back to a login and to store the new token
+        self.token_refresh_margin = timedelta(seconds=60)
+        self.token_refresher = None
+
+    def configure_pools(self, pool_maxsize: int = 32, pool_block: bool = False, keep_alive: bool = True):
+        # pool_maxsize connections are kept per host, with pool_block=True threads wait for a free connection instead
+        # of opening (and afterwards discarding) additional ones
+        # urllib3 only retries failed connections, status codes are retried in _send() with the rate limiter
+        retries = Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.4)
+
+        def adapter():
+            return KeepAliveHTTPAdapter(keep_alive=keep_alive, pool_connections=1, pool_maxsize=pool_maxsize,
+                                        pool_block=pool_block, max_retries=retries)
+
+        self.s.mount('http://', adapter())
+        self.s.mount('https://', adapter())
+        for host in self.pool_hosts:
+            self.s.mount(host, adapter())
+
+    def enable_metrics(self, metrics: Metrics = None) -> Metrics:
+        self.metrics = metrics or Metrics()
+        return self.metrics
+
+    def _send(self, method: str, url: str, endpoint: str, invoke_ids: list = None, timeout_class: str = 'metadata',
+              **kwargs):
+        # all requests go through here: circuit breaker, rate limiter, timeouts, retries and instrumentation
+        self.circuit_breaker.before_request()
+
+        start = time.perf_counter() if self.metrics else None
+        retries = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                r = self.s.request(method, url, timeout=self.timeouts[timeout_class], **kwargs)
+            except requests.RequestException:
+                self.circuit_breaker.record_failure()
+                if self.metrics:
+                    self.metrics.record_request(endpoint, invoke_ids, method, None, time.perf_counter() - start,
+                                                retries=retries)
+                raise
+
+            if r.status_code not in self.retry_statuses:
+                self.rate_limiter.on_success()
+                self.circuit_breaker.record_success()
+                break
+
+            retry_after = parse_retry_after(r.headers.get('Retry-After'))
+            if r.status_code == 429:
+                # the API is not degraded, we are just too fast
+                self.rate_limiter.on_throttled(retry_after)
+                self.circuit_breaker.record_success()
+            else:
+                self.circuit_breaker.record_failure()
+
+            if retries >= self.max_retries or self.circuit_breaker.state == 'open':
+                break
+
+            retries += 1
+            r.close()
+            if r.status_code != 429:
+                time.sleep(min(self.max_backoff, retry_after or self.backoff_factor * 2 ** (retries - 1)))
+
+        if self.metrics:
+            # the urllib3 Retry object of the response contains the retried connection errors
+            connection_retries = getattr(r.raw, 'retries', None)
+            # the body of a streamed response is not read yet, otherwise tell() is the compressed size of the body
+            if kwargs.get('stream'):
+                response_bytes = transfer_bytes = int(r.headers.get('Content-Length') or 0)
+            else:
+                response_bytes = len(r.content)
+                transfer_bytes = r.raw.tell() if hasattr(r.raw, 'tell') else response_bytes
+            self.metrics.record_request(endpoint, invoke_ids, method, r.status_code, time.perf_counter() - start,
+                                        request_bytes=len(r.request.body or b''), response_bytes=response_bytes,
+                                        transfer_bytes=transfer_bytes,
+                                        retries=retries + (len(connection_retries.history) if connection_retries
+                                                           else 0))
+        return r
 
     def headers(self):
+        access_token = self.access_token
         return {
             'User-Agent': 'Mobile|Bugs|5.03.33|Android|12|Pixel 6|Google|market|105033301',
-            'Authorization': f'Bearer {self.access_token}' if self.access_token else '',
+            'Authorization': f'Bearer {access_token}' if access_token else '',
+            'Accept-Encoding': accept_encoding,
         }
 
-    def auth(self, username, password):
-        r = self.s.post('https://secure.bugs.co.kr/api/5/login', params={
+    def _login_params(self, username, password):
+        return {
             'capText': '',
             'device_model': 'android',
             'key': '',
@@ -39,24 +197,68 @@ class BugsApi:
             'udid': self.device_id,
             'userid': username,
             'device_id': self.device_id
-        }, headers=self.headers())
-
-        r = r.json()
-        if r.get('ret_code') == 300:
-            raise ConnectionError('Invalid username or password')
-
-        self.access_token = r['result']['token']['access_token']
-        self.refresh_token = r['result']['token']['refresh_token']
-        self.expires = datetime.now() + timedelta(seconds=r['result']['token']['expires_in'])
+        }
 
-    def get_account(self):
-        r = self.s.post('https://secure.bugs.co.kr/api/5/right', headers=self.headers(), params={
+    def _account_params(self):
+        return {
             'device_model': 'android',
             # 'carrier_name': 'Telekom',
             'device_id': self.device_id
-        })
+        }
+
+    @staticmethod
+    def _auth_json(r, message: str) -> dict:
+        # error pages of the secure API are not always JSON, every failure is a ConnectionError
+        if r.status_code not in {200, 201, 202}:
+            raise ConnectionError(f'{message}, status {r.status_code}')
+        try:
+            return r.json()
+        except ValueError:
+            raise ConnectionError(f'{message}, the response is not JSON')
+
+    def auth(self, username, password):
+        with self._auth_lock:
+            r = self._send('POST', f'{self.secure_url}login', 'login', timeout_class='auth',
+                           params=self._login_params(username, password), headers=self.headers())
+
+            r = self._auth_json(r, 'Login failed')
+            if r.get('ret_code') == 300:
+                raise ConnectionError('Invalid username or password')
+
+            self._set_token(r['result']['token'])
+
+    def refresh(self, stale_access_token: str = None):
+        # get a new access_token with the refresh_token, no password needed, if stale_access_token is given and
+        # another thread already replaced it in the meantime, nothing is done
+        with self._auth_lock:
+            if stale_access_token is not None and self.access_token != stale_access_token:
+                return
+
+            r = self._send('POST', f'{self.secure_url}token/refresh', 'token/refresh', timeout_class='auth', params={
+                'device_model': 'android',
+                'grant_type': 'refresh_token',
+                'refresh_token': self.refresh_token,
+                'device_id': self.device_id
+            }, headers=self.headers())
+
+            r = self._auth_json(r, 'Could not refresh the access_token')
+            if r.get('ret_code') != 0 or not (r.get('result') or {}).get('token'):
+                raise ConnectionError(r.get('ret_msg') or 'Could not refresh the access_token')
+
+            self._set_token(r['result']['token'])
+
+    def _set_token(self, token: dict):
+        with self._token_lock:
+            self.access_token = token['access_token']
+            # keep the old refresh_token if the API does not return a new one
+            self.refresh_token = token.get('refresh_token', self.refresh_token)
+            self.expires = datetime.now() + timedelta(seconds=token['expires_in'])
+
+    def get_account(self):
+        r = self._send('POST', f'{self.secure_url}right', 'right', timeout_class='auth', headers=self.headers(),
+                       params=self._account_params())
 
-        r = r.json()
+        r = self._auth_json(r, 'Could not get the account rights')
 
         if r.get('ret_code') != 0:
             raise ConnectionError(r.get('ret_msg'))
@@ -64,20 +266,23 @@ class BugsApi:
         return r.get('result')
 
     def set_session(self, session: dict):
-        self.device_id = session.get('device_id')
-        self.access_token = session.get('access_token')
-        self.refresh_token = session.get('refresh_token')
-        self.expires = session.get('expires')
+        with self._token_lock:
+            self.device_id = session.get('device_id')
+            self.access_token = session.get('access_token')
+            self.refresh_token = session.get('refresh_token')
+            self.expires = session.get('expires')
 
     def get_session(self):
-        return {
-            'device_id': self.device_id,
-            'access_token': self.access_token,
-            'refresh_token': self.refresh_token,
-            'expires': self.expires
-        }
+        with self._token_lock:
+            return {
+                'device_id': self.device_id,
+                'access_token': self.access_token,
+                'refresh_token': self.refresh_token,
+                'expires': self.expires
+            }
 
-    def _make_call(self, method: str, endpoint: str, params: dict = None, json=None, additional_headers=None):
+    def _make_call(self, method: str, endpoint: str, params: dict = None, json=None, additional_headers=None,
+                   use_cache: bool = True):
         valid_methods = {'GET', 'POST'}
         if method not in valid_methods:
             raise ValueError('method: must be one of %r ' % valid_methods)
@@ -86,26 +291,258 @@ class BugsApi:
         if not params:
             params = {}
 
-        headers = self.headers()
-        if additional_headers:
-            headers.update(additional_headers)
+        # endpoint without ids for the metrics, e.g. "track/lyrics", and the ids of a multi invoke request
+        endpoint_name = ResponseCache.endpoint_names(endpoint)[0]
+        invoke_ids = [call.get('id') for call in json] if isinstance(json, list) else None
+
+        cache_key, cache_ttl, cached, stale = self._cache_lookup(method, endpoint, params, json, use_cache)
+        if cached is not None:
+            if self.metrics:
+                self.metrics.record_cache_hit(endpoint_name, invoke_ids)
+            return loads(cached)
+
+        # an expired response with validators is revalidated instead of downloaded again
+        conditional_headers = self._conditional_headers(method, stale)
+        r = self._request(method, endpoint, params, json, {**(additional_headers or {}), **conditional_headers})
+
+        if conditional_headers and self._not_modified(r, conditional_headers):
+            self.cache.touch(cache_key, cache_ttl)
+            if self.metrics:
+                self.metrics.record_not_modified(endpoint_name, invoke_ids, len(stale[0]))
+            return loads(stale[0])
+
+        if r.status_code not in {200, 201, 202}:
+            raise ConnectionError(r.text)
+
+        if not cache_key:
+            return r.json()
+
+        raw = r.content.decode('utf-8')
+        data = loads(raw)
+        # only store successful responses, the body is stored as received
+        if data.get('ret_code', 0) == 0:
+            self.cache.set_raw(cache_key, raw, cache_ttl, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+
+        return data
+
+    def _request(self, method: str, endpoint: str, params: dict = None, json=None, additional_headers: dict = None,
+                 **kwargs):
+        # sends one API request, the device id is always added to the params. An expired access_token is refreshed
+        # first, a request which is rejected with a 401 is sent once more with a refreshed access_token
+        endpoint_name = ResponseCache.endpoint_names(endpoint)[0]
+        invoke_ids = [call.get('id') for call in json] if isinstance(json, list) else None
 
-        # always add the device id to the params?
+        params = dict(params or {})
         params.update({'device_id': self.device_id})
 
-        if method == 'GET':
-            r = self.s.get(f'https://mapi.bugs.co.kr/music/5/{endpoint}', params=params, headers=headers)
+        # resolving a stream url has its own timeouts
+        timeout_class = 'stream' if endpoint.startswith('play/') else 'metadata'
+
+        # the token a request was sent with, all threads which see it expire or rejected only refresh it once
+        access_token = self.access_token
+        if self._token_expiring():
+            self._refresh_access_token(access_token)
+
+        for attempt in range(2):
+            access_token = self.access_token
+            headers = self.headers()
+            if additional_headers:
+                headers.update(additional_headers)
+
+            r = self._send(method, f'{self.api_url}{endpoint}', endpoint_name, invoke_ids, timeout_class=timeout_class,
+                           params=params, json=json, headers=headers, **kwargs)
+            if r.status_code != 401 or attempt or not self.refresh_token:
+                return r
+
+            r.close()
+            self._refresh_access_token(access_token)
+
+    def _token_expiring(self) -> bool:
+        with self._token_lock:
+            return bool(self.access_token and self.refresh_token and self.expires and
+                        self.expires - self.token_refresh_margin <= datetime.now())
+
+    def _refresh_access_token(self, stale_access_token: str):
+        if self.token_refresher:
+            self.token_refresher(stale_access_token)
         else:
-            r = self.s.post(f'https://mapi.bugs.co.kr/music/5/{endpoint}', params=params, json=json, headers=headers)
+            self.refresh(stale_access_token)
+
+    def _cache_lookup(self, method: str, endpoint: str, params: dict, json, use_cache: bool) -> tuple:
+        # (cache_key, cache_ttl, fresh JSON text, (JSON text, etag, last_modified) of a response to revalidate)
+        if not self.cache or not use_cache:
+            return None, 0, None, None
+
+        cache_ttl = self.cache.ttl(endpoint, json)
+        if cache_ttl <= 0:
+            return None, 0, None, None
+
+        cache_key = self.cache.make_key(method, endpoint, params, json)
+        cached = self.cache.get_raw(cache_key) if not self.cache_bypass else None
+        stale = self.cache.get_stale(cache_key) if cached is None else None
+        return cache_key, cache_ttl, cached, stale
+
+    @staticmethod
+    def _conditional_headers(method: str, stale) -> dict:
+        # If-Modified-Since is only defined for GET, a POST is only revalidated with its ETag
+        if not stale:
+            return {}
+
+        etag, last_modified = stale[1], stale[2]
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified and method == 'GET':
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    @staticmethod
+    def _not_modified(r, conditional_headers: dict) -> bool:
+        # a POST with a matching If-None-Match is answered with 412 instead of 304
+        return r.status_code == 304 or (r.status_code == 412 and 'If-None-Match' in conditional_headers)
+
+    def _stream_list(self, method: str, endpoint: str, path: tuple, params: dict = None, json=None,
+                     use_cache: bool = True):
+        # yields the items of the list at path (see iter_list_items) while the response is still being received, so
+        # large lists never exist as a whole. Responses smaller than stream_threshold and cached ones are read at once
+        params = dict(params or {})
+        endpoint_name = ResponseCache.endpoint_names(endpoint)[0]
+        invoke_ids = [call.get('id') for call in json] if isinstance(json, list) else None
+
+        cache_key, cache_ttl, cached, stale = self._cache_lookup(method, endpoint, params, json, use_cache)
+        if cached is not None:
+            if self.metrics:
+                self.metrics.record_cache_hit(endpoint_name, invoke_ids)
+            yield from iter_list_items([cached.encode()], path)
+            return
+
+        conditional_headers = self._conditional_headers(method, stale)
+        r = self._request(method, endpoint, params, json, conditional_headers, stream=True)
+        with r:
+            if conditional_headers and self._not_modified(r, conditional_headers):
+                self.cache.touch(cache_key, cache_ttl)
+                if self.metrics:
+                    self.metrics.record_not_modified(endpoint_name, invoke_ids, len(stale[0]))
+                yield from iter_list_items([stale[0].encode()], path)
+                return
+
+            if r.status_code not in {200, 201, 202}:
+                raise ConnectionError(r.text)
+
+            content_length = int(r.headers.get('Content-Length') or 0)
+            if 0 < content_length < self.stream_threshold:
+                chunks = [r.content]
+            else:
+                chunks = r.iter_content(self.stream_chunk_size)
+
+            # the encoded body is much smaller than the decoded items, it is kept for the cache
+            body = [] if cache_key else None
+            if body is not None:
+                chunks = (body.append(chunk) or chunk for chunk in chunks)
+
+            yield from iter_list_items(chunks, path)
+
+        if body is not None:
+            raw = b''.join(body).decode()
+            # only store successful responses, the top level ret_code is the last key
+            ret_code = _ret_code.search(raw[-64:])
+            if not ret_code or ret_code.group(1) == '0':
+                self.cache.set_raw(cache_key, raw, cache_ttl, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+
+    def stream_invoke_list(self, calls: list, invoke_id: str, use_cache: bool = True):
+        # the items of the list call invoke_id, which must be the first call, while they are received
+        return self._stream_list('POST', 'multi/invoke/map', ('list', 0, invoke_id, 'list'), json=calls,
+                                 use_cache=use_cache)
+
+    def invoke(self, calls: list, use_cache: bool = True):
+        # send a list of {"id", "args"} calls to the multi invoke endpoint, the returned list has the same order. Every
+        # call is cached on its own, so a batch also serves later single lookups and differently composed batches,
+        # only the calls which are not cached are sent
+        if not self.cache or not use_cache:
+            return self._make_call('POST', 'multi/invoke/map', json=calls, use_cache=False).get('list')
+
+        keys, ttls, results, missing = self._cached_calls(calls)
+        if not missing:
+            return results
+
+        fetched = self._invoke_missing([calls[i] for i in missing], [keys[i] for i in missing],
+                                       [ttls[i] for i in missing])
+        if fetched is None:
+            return None
+
+        for i, result in zip(missing, fetched):
+            results[i] = result
+        return results
+
+    def cached_results(self, calls: list):
+        # the results of calls if all of them are cached, otherwise None
+        if not self.cache:
+            return None
+
+        _, _, results, missing = self._cached_calls(calls)
+        return None if missing else results
+
+    def _cached_calls(self, calls: list) -> tuple:
+        # (cache keys, ttls, results with None for missing calls, indices of the missing calls)
+        keys = [self.cache.call_key(call) for call in calls]
+        ttls = [self.cache.ttl('multi/invoke/map', [call]) for call in calls]
+        results, missing = [None] * len(calls), []
+        for i, (key, ttl) in enumerate(zip(keys, ttls)):
+            cached = self.cache.get_raw(key) if ttl > 0 and not self.cache_bypass else None
+            if cached is None:
+                missing.append(i)
+            else:
+                results[i] = loads(cached).get('list')[0]
+
+        if self.metrics and len(missing) < len(calls):
+            missing_indices = set(missing)
+            self.metrics.record_cache_hit('multi/invoke/map', [call.get('id') for i, call in enumerate(calls)
+                                                               if i not in missing_indices])
+        return keys, ttls, results, missing
+
+    def _invoke_missing(self, calls: list, keys: list, ttls: list):
+        request_key = self.cache.make_key('POST', 'multi/invoke/map', None, calls)
+        invoke_ids = [call.get('id') for call in calls]
+
+        # expired calls can only be revalidated together if all of them were stored from a response to exactly this
+        # request, with the same validators
+        stale = [self.cache.get_stale(key) if ttl > 0 else None for key, ttl in zip(keys, ttls)]
+        revalidate = all(entry and (entry[3] or key) == request_key and entry[1:3] == stale[0][1:3]
+                         for entry, key in zip(stale, keys))
+        conditional_headers = self._conditional_headers('POST', stale[0] if revalidate else None)
+
+        r = self._request('POST', 'multi/invoke/map', json=calls, additional_headers=conditional_headers)
+        if conditional_headers and self._not_modified(r, conditional_headers):
+            for key, ttl in zip(keys, ttls):
+                self.cache.touch(key, ttl)
+            if self.metrics:
+                self.metrics.record_not_modified('multi/invoke/map', invoke_ids, sum(len(e[0]) for e in stale))
+            return [loads(entry[0]).get('list')[0] for entry in stale]
 
         if r.status_code not in {200, 201, 202}:
             raise ConnectionError(r.text)
 
-        return r.json()
-
-    def get_artist(self, artist_id: str or int):
+        raw = r.content.decode('utf-8')
+        data = loads(raw)
+        results = data.get('list')
+        # only store successful responses, a single call is stored as received
+        if data.get('ret_code', 0) == 0 and results is not None and len(results) == len(calls):
+            etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+            if len(calls) == 1:
+                entries = [(keys[0], raw, ttls[0], etag, last_modified, None)]
+            else:
+                entries = [(key, dumps({'list': [result], 'ret_code': 0}, separators=(',', ':')), ttl, etag,
+                            last_modified, request_key) for key, ttl, result in zip(keys, ttls, results)]
+            self.cache.set_many(entries)
+
+        return results
+
+    # the multi invoke calls of every lookup, public so other modules can batch them or page through them, see
+    # ArtistSync.listings
+    @staticmethod
+    def artist_calls(artist_id: str or int):
         artist_id = int(artist_id)
-        return self._make_call('POST', 'multi/invoke/map', json=[{
+        return [{
             "id": "artist",
             "args": {
                 "artist_id": artist_id,
@@ -116,65 +553,66 @@ class BugsApi:
             "args": {
                 "artist_id": artist_id
             },
-        }]).get('list')
+        }]
 
-    def get_artist_tracks(self, artist_id: str or int, page: int = 1, limit: int = 9999):
-        artist_id = int(artist_id)
-        return self._make_call('POST', 'multi/invoke/map', json=[{
+    @staticmethod
+    def artist_tracks_calls(artist_id: str or int, page: int = 1, limit: int = 9999):
+        return [{
             "id": "artist_track",
             "args": {
-                "artist_id": artist_id,
+                "artist_id": int(artist_id),
                 "filter": "ALL",
                 "page": page,
                 "result_type": "LIST",
                 "size": limit,
                 "sort": "POPULAR"
             }
-        }]).get('list')
+        }]
 
-    def get_artist_albums(self, artist_id: str or int, page: int = 1, limit: int = 9999):
-        artist_id = int(artist_id)
-        return self._make_call('POST', 'multi/invoke/map', json=[{
+    @staticmethod
+    def artist_albums_calls(artist_id: str or int, page: int = 1, limit: int = 9999):
+        return [{
             "id": "artist_album_filter_release",
             "args": {
-                "artist_id": artist_id,
+                "artist_id": int(artist_id),
                 "page": page,
                 "result_type": "LIST",
                 "size": limit,
                 "sort": "recent"
             }
-        }]).get('list')
+        }]
 
-    def get_artist_compilation_albums(self, artist_id: str or int, page: int = 1, limit: int = 9999):
-        artist_id = int(artist_id)
-        return self._make_call('POST', 'multi/invoke/map', json=[{
+    @staticmethod
+    def artist_compilation_albums_calls(artist_id: str or int, page: int = 1, limit: int = 9999):
+        return [{
             "id": "artist_album_filter_joincompil",
             "args": {
-                "artist_id": artist_id,
+                "artist_id": int(artist_id),
                 "page": page,
                 "result_type": "LIST",
                 "size": limit,
                 "sort": "recent"
             }
-        }]).get('list')
+        }]
 
-    def get_artist_videos(self, artist_id: str or int, page: int = 1, limit: int = 9999):
-        artist_id = int(artist_id)
-        return self._make_call('POST', 'multi/invoke/map', json=[{
+    @staticmethod
+    def artist_videos_calls(artist_id: str or int, page: int = 1, limit: int = 9999):
+        return [{
             "id": "artist_mv",
             "args": {
-                "artist_ids": str(artist_id),
+                "artist_ids": str(int(artist_id)),
                 "filter": "ALL",
                 "page": page,
                 "result_type": "LIST",
                 "size": limit,
                 "sort": "recent"
             }
-        }]).get('list')
+        }]
 
-    def get_album(self, album_id: str or int):
+    @staticmethod
+    def album_calls(album_id: str or int):
         album_id = int(album_id)
-        return self._make_call('POST', 'multi/invoke/map', json=[{
+        return [{
             "id": "album",
             "args": {
                 "album_id": album_id,
@@ -191,21 +629,22 @@ class BugsApi:
             "args": {
                 "album_id": album_id
             }
-        }]).get('list')
+        }]
 
-    def get_album_tracks(self, album_id: str or int):
-        album_id = int(album_id)
-        return self._make_call('POST', 'multi/invoke/map', json=[{
+    @staticmethod
+    def album_tracks_calls(album_id: str or int):
+        return [{
             "id": "album_track",
             "args": {
-                "album_id": album_id,
+                "album_id": int(album_id),
                 "result_type": "LIST"
             }
-        }]).get('list')
+        }]
 
-    def get_track(self, track_id: str or int):
+    @staticmethod
+    def track_calls(track_id: str or int):
         track_id = int(track_id)
-        return self._make_call('POST', 'multi/invoke/map', json=[{
+        return [{
             "id": "track",
             "args": {
                 "track_id": track_id,
@@ -216,36 +655,348 @@ class BugsApi:
             "args": {
                 "track_id": track_id
             }
-        }]).get('list')
+        }]
+
+    def get_artist(self, artist_id: str or int):
+        # single lookups go through the batcher, concurrent callers share one multi invoke request
+        return self.batcher.call(self.artist_calls(artist_id))
+
+    def get_artist_tracks(self, artist_id: str or int, page: int = 1, limit: int = 9999):
+        return self.invoke(self.artist_tracks_calls(artist_id, page, limit))
+
+    def get_artist_albums(self, artist_id: str or int, page: int = 1, limit: int = 9999):
+        return self.invoke(self.artist_albums_calls(artist_id, page, limit))
+
+    def get_artist_compilation_albums(self, artist_id: str or int, page: int = 1, limit: int = 9999):
+        return self.invoke(self.artist_compilation_albums_calls(artist_id, page, limit))
+
+    def get_artist_videos(self, artist_id: str or int, page: int = 1, limit: int = 9999):
+        return self.invoke(self.artist_videos_calls(artist_id, page, limit))
+
+    def stream_artist_tracks(self, artist_id: str or int, page: int = 1, limit: int = 9999):
+        return self.stream_invoke_list(self.artist_tracks_calls(artist_id, page, limit), 'artist_track')
+
+    def stream_artist_albums(self, artist_id: str or int, page: int = 1, limit: int = 9999):
+        return self.stream_invoke_list(self.artist_albums_calls(artist_id, page, limit),
+                                       'artist_album_filter_release')
+
+    def stream_artist_compilation_albums(self, artist_id: str or int, page: int = 1, limit: int = 9999):
+        return self.stream_invoke_list(self.artist_compilation_albums_calls(artist_id, page, limit),
+                                       'artist_album_filter_joincompil')
+
+    def iter_artist_tracks(self, artist_id: str or int, page_size: int = 100, prefetch: int = 0):
+        return self._iter_pages(lambda page, size: self.artist_tracks_calls(artist_id, page, size),
+                                'artist_track', page_size, prefetch)
+
+    def iter_artist_albums(self, artist_id: str or int, page_size: int = 100, prefetch: int = 0):
+        return self._iter_pages(lambda page, size: self.artist_albums_calls(artist_id, page, size),
+                                'artist_album_filter_release', page_size, prefetch)
+
+    def iter_artist_compilation_albums(self, artist_id: str or int, page_size: int = 100, prefetch: int = 0):
+        return self._iter_pages(lambda page, size: self.artist_compilation_albums_calls(artist_id, page, size),
+                                'artist_album_filter_joincompil', page_size, prefetch)
+
+    def iter_artist_videos(self, artist_id: str or int, page_size: int = 100, prefetch: int = 0):
+        return self._iter_pages(lambda page, size: self.artist_videos_calls(artist_id, page, size),
+                                'artist_mv', page_size, prefetch)
+
+    def get_artist_full(self, artist_id: str or int, include_compilations: bool = False, page_size: int = 100,
+                        prefetch: int = 0):
+        # artist, artist images and the first page of tracks, albums and compilations in one multi invoke request,
+        # listings with more than one page are then completed concurrently
+        listings = {
+            'tracks': (lambda page, size: self.artist_tracks_calls(artist_id, page, size), 'artist_track'),
+            'albums': (lambda page, size: self.artist_albums_calls(artist_id, page, size),
+                       'artist_album_filter_release'),
+        }
+        if include_compilations:
+            listings['compilations'] = (lambda page, size: self.artist_compilation_albums_calls(artist_id, page, size),
+                                        'artist_album_filter_joincompil')
+
+        calls = self.artist_calls(artist_id)
+        for calls_builder, _ in listings.values():
+            calls += calls_builder(1, page_size)
+        results = self.invoke(calls)
+
+        artist = {
+            'artist': results[0].get('artist').get('result'),
+            'artist_image': results[1].get('artist_image').get('list') or [],
+        }
+        for i, (name, (_, invoke_id)) in enumerate(listings.items()):
+            artist[name] = (results[2 + i].get(invoke_id) or {}).get('list') or []
+
+        # the first page already tells how many items there are, so no page past the end is requested
+        totals = {name: self._total_count(results[2 + i].get(invoke_id))
+                  for i, (name, (_, invoke_id)) in enumerate(listings.items())}
+        incomplete = [name for name in listings if len(artist[name]) >= page_size
+                      and (totals[name] is None or totals[name] > len(artist[name]))]
+        if incomplete:
+            with ThreadPoolExecutor(max_workers=len(incomplete)) as executor:
+                futures = {name: executor.submit(list, self._iter_pages(*listings[name], page_size, prefetch, 2,
+                                                                        totals[name]))
+                           for name in incomplete}
+                for name, future in futures.items():
+                    artist[name] += future.result()
+
+        return artist
+
+    @staticmethod
+    def _total_count(listing: dict or None):
+        # number of items of the whole paged list, None if the response has no pager
+        return ((listing or {}).get('pager') or {}).get('total_count')
+
+    def _fetch_page(self, calls_builder, invoke_id: str, page: int, page_size: int) -> tuple:
+        # (items, total_count) of one page
+        result = self.invoke(calls_builder(page, page_size))
+        listing = result[0].get(invoke_id) if result else None
+        return (listing or {}).get('list') or [], self._total_count(listing)
+
+    def _iter_pages(self, calls_builder, invoke_id: str, page_size: int = 100, prefetch: int = 0, start_page: int = 1,
+                    total_count: int = None):
+        # yields the items of a paged list call page by page, a page with less than page_size items or the page with
+        # the last of pager.total_count items is the last one. With prefetch > 0 the next pages are already requested
+        # while the current one is consumed, but never past total_count once it is known
+        def is_last(page: int, items: list) -> bool:
+            return len(items) < page_size or (total_count is not None and page * page_size >= total_count)
+
+        # e.g. a first page which was exactly full
+        if total_count is not None and (start_page - 1) * page_size >= total_count:
+            return
+
+        if prefetch <= 0:
+            page = start_page
+            while True:
+                items, page_total = self._fetch_page(calls_builder, invoke_id, page, page_size)
+                total_count = page_total if page_total is not None else total_count
+                yield from items
+                if is_last(page, items):
+                    return
+                page += 1
+
+        executor = ThreadPoolExecutor(max_workers=prefetch)
+        try:
+            pending = deque()
+            page = next_page = start_page
+            while True:
+                # until the first page tells total_count only that page is requested
+                limit = prefetch if total_count is not None or page > start_page else 0
+                while len(pending) <= limit and (total_count is None or (next_page - 1) * page_size < total_count):
+                    pending.append(executor.submit(self._fetch_page, calls_builder, invoke_id, next_page, page_size))
+                    next_page += 1
+
+                items, page_total = pending.popleft().result()
+                total_count = page_total if page_total is not None else total_count
+                yield from items
+                if is_last(page, items):
+                    return
+                page += 1
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_album(self, album_id: str or int):
+        return self.batcher.call(self.album_calls(album_id))
+
+    def get_album_tracks(self, album_id: str or int):
+        return self.batcher.call(self.album_tracks_calls(album_id))
+
+    def submit_album_tracks(self, album_id: str or int) -> Future:
+        # non-blocking get_album_tracks(), lets a following get_album() go out in the same multi invoke request
+        return self.batcher.submit(self.album_tracks_calls(album_id))
+
+    def stream_album_tracks(self, album_id: str or int):
+        return self.stream_invoke_list(self.album_tracks_calls(album_id), 'album_track')
+
+    def get_track(self, track_id: str or int):
+        return self.batcher.call(self.track_calls(track_id))
+
+    def get_tracks(self, track_ids: list):
+        # batched get_track(), returns {track_id: get_track() list}
+        return self._get_many(self.track_calls, track_ids)
+
+    def get_albums(self, album_ids: list):
+        # batched get_album(), returns {album_id: get_album() list}
+        return self._get_many(self.album_calls, album_ids)
+
+    def get_albums_tracks(self, album_ids: list):
+        # batched get_album_tracks(), returns {album_id: get_album_tracks() list}
+        return self._get_many(self.album_tracks_calls, album_ids)
+
+    def get_artists(self, artist_ids: list):
+        # batched get_artist(), returns {artist_id: get_artist() list}
+        return self._get_many(self.artist_calls, artist_ids)
+
+    def _get_many(self, calls_builder, ids: list):
+        # submit everything first so the batcher can fill up whole batches, then collect the results
+        futures = {i: self.batcher.submit(calls_builder(i)) for i in dict.fromkeys(ids)}
+        self.batcher.flush()
+        return {i: f.result() for i, f in futures.items()}
 
     def get_lyrics(self, track_id: str or int):
         return self._make_call('GET', f'track/{track_id}/lyrics')
 
-    def get_stream(self, track_id: int, bitrate: str = 'flac'):
+    @staticmethod
+    def _stream_params(bitrate: str = 'flac'):
         # bitrate is either 'flac24', 'flac', 'aac256', 'aac', '320k'
         valid_bitrate = {'flac24', 'flac', 'aac256', 'aac', '320k'}
         if bitrate not in valid_bitrate:
             raise ValueError('bitrate: must be one of %r ' % valid_bitrate)
 
-        return self._make_call('GET', f'play/track/{track_id}/streaming', params={
+        return {
             'bitrate': bitrate,
             'wwan': 'N',
             'overwrite_session': 'Y'
-        }).get('result')
+        }
 
-    def get_search(self, query: str):
-        return self._make_call('POST', 'multi/invoke/map', json=[{
+    @staticmethod
+    def search_calls(query: str):
+        return [{
             "id": "get_search_combine",
             "args": {
                 "query": query
             }
-        }]).get('list')
+        }]
 
-    def get_search_individually(self, query: str, category: str = 'track', page: int = 1, limit: int = 100):
-        return self._make_call('GET', f'search/{category}', params={
+    @staticmethod
+    def _search_params(query: str, page: int = 1, limit: int = 100):
+        return {
             'query': query,
             'page': page,
             'size': limit,
             'sort': 'exact',
             'flac_str_only': 'N'
-        })
+        }
+
+    def get_stream(self, track_id: int, bitrate: str = 'flac'):
+        return self._make_call('GET', f'play/track/{track_id}/streaming', params=self._stream_params(bitrate),
+                               use_cache=False).get('result')
+
+    def get_search(self, query: str):
+        return self.invoke(self.search_calls(query))
+
+    def get_search_individually(self, query: str, category: str = 'track', page: int = 1, limit: int = 100):
+        return self._make_call('GET', f'search/{category}', params=self._search_params(query, page, limit))
+
+    def stream_search(self, query: str, category: str = 'track', page: int = 1, limit: int = 100):
+        return self._stream_list('GET', f'search/{category}', ('list',), params=self._search_params(query, page, limit))
+
+    def iter_search(self, query: str, category: str = 'track', page_size: int = 20, limit: int = None):
+        # yields the results of one category ("track", "album", "artist", "mv") page by page, stops after limit items.
+        # The API pages by page number, so every page has the same size, only a limit below one page makes it smaller
+        if limit is not None:
+            page_size = min(page_size, limit)
+
+        page = 1
+        while limit is None or limit > 0:
+            items = self.get_search_individually(query, category, page, page_size).get('list') or []
+            yield from items if limit is None else items[:limit]
+
+            if limit is not None:
+                limit -= len(items)
+            if len(items) < page_size:
+                return
+            page += 1
+
+
+class MultiInvokeBatcher:
+    # collects pending multi invoke calls and sends them as one request, either if max_batch_size calls are pending
+    # or after flush_deadline seconds since the first pending call. Full batches and the chunks of a flush with more
+    # than max_batch_size calls are sent as up to max_workers concurrent requests
+    def __init__(self, api: BugsApi, max_batch_size: int = 50, flush_deadline: float = 0.01, max_workers: int = 4):
+        self.api = api
+        self.max_batch_size = max_batch_size
+        self.flush_deadline = flush_deadline
+        self.max_workers = max_workers
+
+        self._lock = threading.Lock()
+        # list of (calls, future) tuples
+        self._pending = []
+        self._timer = None
+        # sends full batches and the additional chunks of a large flush, created on first use
+        self._executor = None
+
+    def submit(self, calls: list) -> Future:
+        # calls is a list of {"id", "args"} dicts, the future resolves to the part of the result list for those calls
+        future = Future()
+        # cached calls do not wait for the flush deadline
+        results = self.api.cached_results(calls)
+        if results is not None:
+            future.set_result(results)
+            return future
+
+        with self._lock:
+            self._pending.append((calls, future))
+            pending_calls = sum(len(c) for c, _ in self._pending)
+
+            if pending_calls >= self.max_batch_size:
+                batch = self._take_batch()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.flush_deadline, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        # a full batch is sent by the executor so the caller can go on submitting while it is in flight
+        if batch:
+            self._get_executor().submit(self._send, batch)
+        return future
+
+    def call(self, calls: list):
+        # blocking version of submit()
+        return self.submit(calls).result()
+
+    def flush(self):
+        # send everything which is pending right now
+        with self._lock:
+            batch = self._take_batch()
+
+        if batch:
+            self._send(batch)
+
+    def _take_batch(self):
+        # must be called with self._lock held
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _send(self, batch: list):
+        # split the batch into requests with at most max_batch_size calls, a single caller is never split up
+        chunks, chunk, chunk_size = [], [], 0
+        for calls, future in batch:
+            if chunk and chunk_size + len(calls) > self.max_batch_size:
+                chunks.append(chunk)
+                chunk, chunk_size = [], 0
+            chunk.append((calls, future))
+            chunk_size += len(calls)
+
+        if chunk:
+            chunks.append(chunk)
+
+        # the first chunk is sent by the flushing thread, all others concurrently, every caller waits for its future
+        for chunk in chunks[1:]:
+            self._get_executor().submit(self._send_chunk, chunk)
+        if chunks:
+            self._send_chunk(chunks[0])
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='bugs-batcher')
+            return self._executor
+
+    def _send_chunk(self, chunk: list):
+        try:
+            results = self.api.invoke([call for calls, _ in chunk for call in calls]) or []
+        except Exception as e:
+            for _, future in chunk:
+                future.set_exception(e)
+            return
+
+        # hand every caller its own slice of the result list
+        offset = 0
+        for calls, future in chunk:
+            future.set_result(results[offset:offset + len(calls)])
+            offset += len(calls)
@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from fnmatch import fnmatch
+
+
+class ResponseCache:
+    # time to live in seconds for every endpoint, multi invoke calls are matched by their "id", all other endpoints
+    # by their path without the numeric ids, e.g. "track/lyrics" or "search/track"
+    default_ttls = {
+        'track': 7 * 24 * 3600,
+        'track_artist_role': 7 * 24 * 3600,
+        'album': 7 * 24 * 3600,
+        'album_artist_role': 7 * 24 * 3600,
+        'album_image': 7 * 24 * 3600,
+        'album_track': 7 * 24 * 3600,
+        'artist': 24 * 3600,
+        'artist_image': 24 * 3600,
+        'artist_track': 6 * 3600,
+        'artist_album_filter_*': 6 * 3600,
+        'artist_mv': 6 * 3600,
+        'track/lyrics': 30 * 24 * 3600,
+        'get_search_combine': 3600,
+        'search/*': 3600,
+    }
+
+    # stream urls are signed and expire, never cache them regardless of the configured ttls
+    never_cache = ('play/*',)
+
+    def __init__(self, path: str, max_size: int = 256 * 1024 * 1024, ttls: dict = None):
+        self.path = path
+        self.max_size = max_size
+        self.ttls = dict(self.default_ttls)
+        if ttls:
+            self.ttls.update(ttls)
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'key TEXT PRIMARY KEY, '
+                         'value TEXT NOT NULL, '
+                         'size INTEGER NOT NULL, '
+                         'expires REAL NOT NULL, '
+                         'last_access REAL NOT NULL, '
+                         'etag TEXT, '
+                         'last_modified TEXT, '
+                         'request_key TEXT)')
+        self._migrate()
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def _migrate(self):
+        # version 1 added the ETag/Last-Modified validators, version 2 the request_key of multi invoke calls
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version < 2:
+            columns = {row[1] for row in self._db.execute('PRAGMA table_info(responses)')}
+            for column in ('etag', 'last_modified', 'request_key'):
+                if column not in columns:
+                    self._db.execute(f'ALTER TABLE responses ADD COLUMN {column} TEXT')
+            self._db.execute('PRAGMA user_version = 2')
+
+    @staticmethod
+    def endpoint_names(endpoint: str, json_data=None) -> list:
+        if isinstance(json_data, list):
+            return [call.get('id') for call in json_data]
+
+        return ['/'.join(part for part in endpoint.split('/') if not part.isdigit())]
+
+    def ttl(self, endpoint: str, json_data=None) -> int:
+        # a multi invoke request is only cached as long as its shortest living call, unknown endpoints are not cached
+        ttls = []
+        for name in self.endpoint_names(endpoint, json_data):
+            if any(fnmatch(name, pattern) for pattern in self.never_cache):
+                return 0
+
+            ttl = self.ttls.get(name)
+            if ttl is None:
+                ttl = next((t for pattern, t in self.ttls.items() if fnmatch(name, pattern)), 0)
+            ttls.append(ttl)
+
+        return min(ttls) if ttls else 0
+
+    @staticmethod
+    def make_key(method: str, endpoint: str, params: dict = None, json_data=None) -> str:
+        # the device_id is always added to the params and does not change the response
+        params = {k: v for k, v in (params or {}).items() if k != 'device_id'}
+        raw = json.dumps([method, endpoint, params, json_data], sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @classmethod
+    def call_key(cls, call: dict) -> str:
+        # a single multi invoke call is stored like a request which only contains this call
+        return cls.make_key('POST', 'multi/invoke/map', None, [call])
+
+    def get(self, key: str):
+        value = self.get_raw(key)
+        return json.loads(value) if value is not None else None
+
+    def get_raw(self, key: str):
+        # the stored JSON text, for decoding it incrementally
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT value, expires FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            value, expires = row
+            if expires < now:
+                return None
+
+            try:
+                self._db.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+            except sqlite3.OperationalError as e:
+                # only the LRU order is lost, e.g. if another process locks the database
+                logging.debug(f'Bugs: could not update the metadata cache: {e}')
+
+        return value
+
+    def get_stale(self, key: str):
+        # (value, etag, last_modified, request_key) of an expired response which can be revalidated, None if there is
+        # none. request_key is the key of the multi invoke request the call was stored from, None if it is the key
+        with self._lock:
+            row = self._db.execute('SELECT value, etag, last_modified, request_key FROM responses WHERE key = ? AND '
+                                   '(etag IS NOT NULL OR last_modified IS NOT NULL)', (key,)).fetchone()
+
+        return tuple(row) if row else None
+
+    def touch(self, key: str, ttl: int):
+        # the response was revalidated, it is fresh again for ttl seconds
+        now = time.time()
+        with self._lock:
+            try:
+                self._db.execute('UPDATE responses SET expires = ?, last_access = ? WHERE key = ?',
+                                 (now + ttl, now, key))
+            except sqlite3.OperationalError as e:
+                logging.warning(f'Bugs: could not update the metadata cache: {e}')
+
+    def set(self, key: str, value, ttl: int, etag: str = None, last_modified: str = None):
+        if ttl <= 0:
+            return
+
+        self.set_raw(key, json.dumps(value, separators=(',', ':')), ttl, etag, last_modified)
+
+    def set_raw(self, key: str, raw: str, ttl: int, etag: str = None, last_modified: str = None,
+                request_key: str = None):
+        # stores already encoded JSON text, e.g. a response body which was decoded incrementally
+        self.set_many([(key, raw, ttl, etag, last_modified, request_key)])
+
+    def set_many(self, entries: list):
+        # [(key, raw, ttl, etag, last_modified, request_key)] in one transaction. The cache is only an optimization,
+        # if the database can not be written (e.g. it is locked by another process) the entries are dropped
+        now = time.time()
+        entries = [e for e in entries if e[2] > 0 and len(e[1]) <= self.max_size]
+        if not entries:
+            return
+
+        with self._lock:
+            try:
+                self._db.execute('BEGIN')
+                size_change = 0
+                for key, raw, ttl, etag, last_modified, request_key in entries:
+                    old = self._db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+                    self._db.execute('INSERT OR REPLACE INTO responses (key, value, size, expires, last_access, etag, '
+                                     'last_modified, request_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                     (key, raw, len(raw), now + ttl, now, etag, last_modified, request_key))
+                    size_change += len(raw) - (old[0] if old else 0)
+                self._db.execute('COMMIT')
+            except sqlite3.OperationalError as e:
+                if self._db.in_transaction:
+                    self._db.execute('ROLLBACK')
+                logging.warning(f'Bugs: could not write to the metadata cache: {e}')
+                return
+
+            self._size += size_change
+            try:
+                self._evict()
+            except sqlite3.OperationalError as e:
+                logging.warning(f'Bugs: could not evict from the metadata cache: {e}')
+
+    def _evict(self):
+        # must be called with self._lock held, removes expired entries first (even if they could be revalidated) and
+        # then the least recently used ones
+        if self._size <= self.max_size:
+            return
+
+        self._db.execute('DELETE FROM responses WHERE expires < ?', (time.time(),))
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+        while self._size > self.max_size:
+            rows = self._db.execute('SELECT key, size FROM responses ORDER BY last_access LIMIT 100').fetchall()
+            if not rows:
+                break
+
+            evicted = []
+            for key, size in rows:
+                evicted.append((key,))
+                self._size -= size
+                if self._size <= self.max_size:
+                    break
+
+            self._db.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SingleFlightLRU:
+    # bounded in-process LRU, concurrent get() calls for the same missing key wait for a single loader call
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._in_flight = {}
+
+    def get(self, key, loader):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = loader()
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._store(key, value)
+            del self._in_flight[key]
+        future.set_result(value)
+
+        return value
+
+    def peek(self, key, default=None):
+        with self._lock:
+            return self._items.get(key, default)
+
+    def put(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def discard(self, key, value=None):
+        # removes key, if value is given only if it is still the stored value
+        with self._lock:
+            if key in self._items and (value is None or self._items[key] is value):
+                del self._items[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def _store(self, key, value):
+        # must be called with self._lock held
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import requests
+
+# 3001 is needed for the "uncompressed" cover
+supported_sizes = [75, 140, 200, 350, 500, 1000, 1280, 1400, 2000, 3001]
+
+
+def artwork_size(size: int, max_size: int = 3000):
+    # rounds the size to the nearest number in supported_sizes, 'original' for the "uncompressed" cover if the
+    # nearest size is bigger than max_size
+    best_size = min(supported_sizes, key=lambda x: abs(x - size))
+    return best_size if best_size <= max_size else 'original'
+
+
+def artwork_url(cover_path: str, size: int, max_size: int = 3000) -> str:
+    return _bucket_url(cover_path, artwork_size(size, max_size))
+
+
+def _bucket_url(cover_path: str, size_bucket) -> str:
+    return f'https://image.bugsm.co.kr/album/images/{size_bucket}{cover_path}'
+
+
+class CoverCache:
+    # album covers on disk, one file per (image path, size bucket), so all tracks of an album share one download.
+    # Concurrent requests for the same cover wait for a single download, the least recently used files are removed
+    # when the folder grows over max_size bytes
+    def __init__(self, folder: str, max_size: int = 256 * 1024 * 1024, session: requests.Session = None,
+                 timeout: float = 30):
+        self.folder = folder
+        self.max_size = max_size
+        self.s = session or requests.Session()
+        self.timeout = timeout
+        os.makedirs(folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        # file name: size, oldest access first
+        self._files = OrderedDict()
+        self._size = 0
+
+        entries = [e for e in os.scandir(folder) if e.is_file() and e.name.endswith('.jpg')]
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            self._files[entry.name] = entry.stat().st_size
+            self._size += entry.stat().st_size
+
+    @staticmethod
+    def file_name(cover_path: str, size_bucket) -> str:
+        return hashlib.sha256(f'{cover_path}|{size_bucket}'.encode()).hexdigest() + '.jpg'
+
+    def get(self, cover_path: str, size: int, max_size: int = 3000) -> str:
+        # returns the path of the local cover file, downloads it if needed
+        size_bucket = artwork_size(size, max_size)
+        name = self.file_name(cover_path, size_bucket)
+        file_path = os.path.join(self.folder, name)
+
+        with self._lock:
+            if name in self._files and os.path.isfile(file_path):
+                self._files.move_to_end(name)
+                # the modification time is the access time after a restart
+                os.utime(file_path)
+                return file_path
+
+            future = self._in_flight.get(name)
+            owner = future is None
+            if owner:
+                future = self._in_flight[name] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            self._download(_bucket_url(cover_path, size_bucket), file_path)
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[name]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._size += os.path.getsize(file_path) - self._files.pop(name, 0)
+            self._files[name] = os.path.getsize(file_path)
+            self._evict(keep=name)
+            del self._in_flight[name]
+        future.set_result(file_path)
+
+        return file_path
+
+    def _download(self, url: str, file_path: str):
+        r = self.s.get(url, timeout=self.timeout)
+        if r.status_code != 200:
+            raise ConnectionError(f'Cover download failed with status {r.status_code}: {url}')
+
+        # write to a temporary file first, a crash never leaves a truncated cover behind
+        temp_path = f'{file_path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(r.content)
+        os.replace(temp_path, file_path)
+
+    def _evict(self, keep: str = None):
+        # must be called with self._lock held, the just downloaded file is never removed
+        while self._size > self.max_size and len(self._files) > 1:
+            name, size = next(iter(self._files.items()))
+            if name == keep:
+                self._files.move_to_end(name)
+                continue
+
+            del self._files[name]
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for name in self._files:
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    pass
+            self._files.clear()
+            self._size = 0
@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class RangedDownloader:
+    # downloads a file with several HTTP Range requests in parallel into a preallocated file, finished chunks are
+    # written to a "<file>.journal" file so an interrupted download continues where it stopped
+    def __init__(self, connections: int = 4, chunk_size: int = 4 * 1024 * 1024, max_retries: int = 3,
+                 timeout: float = 30):
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(connections, 10))
+        self.s.mount('http://', adapter)
+        self.s.mount('https://', adapter)
+
+    def download(self, url: str, file_path: str, resolve_url=None) -> str:
+        # resolve_url is called to get a new url if the signed url expired (403/410) during the download
+        state = _DownloadState(url, resolve_url)
+
+        size = self._get_size(state)
+        if size is None:
+            # the server does not support ranges, download the whole file with one connection
+            self._download_whole(state, file_path)
+            return file_path
+
+        journal_path = f'{file_path}.journal'
+        done = self._read_journal(journal_path, size)
+
+        # preallocate the file, an existing file is only kept if the journal belongs to it
+        if not done or not os.path.isfile(file_path):
+            done = set()
+            with open(file_path, 'wb') as f:
+                f.truncate(size)
+
+        chunks = [i for i in range((size + self.chunk_size - 1) // self.chunk_size) if i not in done]
+        journal_lock = threading.Lock()
+
+        def download_chunk(index: int):
+            start = index * self.chunk_size
+            end = min(start + self.chunk_size, size) - 1
+            self._download_range(state, file_path, start, end)
+
+            with journal_lock:
+                done.add(index)
+                self._write_journal(journal_path, size, done)
+
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            # result() raises the first failed chunk, the journal keeps the progress of all finished ones
+            for future in [executor.submit(download_chunk, i) for i in chunks]:
+                future.result()
+
+        if os.path.isfile(journal_path):
+            os.remove(journal_path)
+
+        return file_path
+
+    def _request(self, state, headers: dict = None, stream: bool = False):
+        # retries connection errors and re-resolves expired urls
+        for attempt in range(self.max_retries + 1):
+            url = state.url
+            try:
+                r = self.s.get(url, headers=headers, stream=stream, timeout=self.timeout)
+            except requests.ConnectionError:
+                if attempt == self.max_retries:
+                    raise
+                continue
+
+            if r.status_code in {403, 410} and state.resolve_url and attempt < self.max_retries:
+                r.close()
+                state.refresh(url)
+                continue
+
+            if r.status_code not in {200, 206}:
+                r.close()
+                raise ConnectionError(f'Download failed with status code {r.status_code}')
+
+            return r
+
+    def _get_size(self, state):
+        r = self._request(state, headers={'Range': 'bytes=0-0'}, stream=True)
+        r.close()
+
+        content_range = r.headers.get('Content-Range')
+        if r.status_code != 206 or not content_range or content_range.endswith('/*'):
+            return None
+
+        return int(content_range.rsplit('/', 1)[1])
+
+    def _download_range(self, state, file_path: str, start: int, end: int):
+        for attempt in range(self.max_retries + 1):
+            r = self._request(state, headers={'Range': f'bytes={start}-{end}'}, stream=True)
+            try:
+                if r.status_code != 206:
+                    raise ConnectionError('Server ignored the Range header')
+
+                position = start
+                with open(file_path, 'r+b') as f:
+                    f.seek(start)
+                    for data in r.iter_content(chunk_size=64 * 1024):
+                        f.write(data)
+                        position += len(data)
+
+                if position == end + 1:
+                    return
+            except requests.RequestException:
+                if attempt == self.max_retries:
+                    raise
+            finally:
+                r.close()
+
+        raise ConnectionError(f'Could not download bytes {start}-{end}')
+
+    def _download_whole(self, state, file_path: str):
+        r = self._request(state, stream=True)
+        with r, open(file_path, 'wb') as f:
+            for data in r.iter_content(chunk_size=64 * 1024):
+                f.write(data)
+
+    def _read_journal(self, journal_path: str, size: int) -> set:
+        try:
+            with open(journal_path) as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return set()
+
+        # the journal is only valid for the same file size and chunk size
+        if journal.get('size') != size or journal.get('chunk_size') != self.chunk_size:
+            return set()
+
+        return set(journal.get('done', []))
+
+    def _write_journal(self, journal_path: str, size: int, done: set):
+        with open(f'{journal_path}.tmp', 'w') as f:
+            json.dump({'size': size, 'chunk_size': self.chunk_size, 'done': sorted(done)}, f)
+        os.replace(f'{journal_path}.tmp', journal_path)
+
+
+class _DownloadState:
+    # current url of a download, shared by all chunk workers
+    def __init__(self, url: str, resolve_url=None):
+        self.url = url
+        self.resolve_url = resolve_url
+        self._lock = threading.Lock()
+
+    def refresh(self, expired_url: str):
+        # only the first worker which sees the expired url resolves a new one
+        with self._lock:
+            if self.url == expired_url:
+                self.url = self.resolve_url()
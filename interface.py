@@ -1,25 +1,78 @@
 import logging
+import os
 import random
 import string
+import threading
+import time
 
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+
+import requests
 
 from utils.models import *
 from .bugs_api import BugsApi
+from .cache import ResponseCache, SingleFlightLRU
+from .covers import CoverCache, artwork_url
+from .downloader import RangedDownloader
+from .lyrics import parse_time_lyrics
+from .manifest import ManifestWriter, parse_url
+from .matcher import TrackMatcher
+from .records import TrackRecord, convert_duration_str_to_secs
+from .sync import ArtistSync, WatermarkStore
 
 module_information = ModuleInformation(
     service_name='Bugs',
     module_supported_modes=ModuleModes.download | ModuleModes.covers | ModuleModes.lyrics,
-    session_settings={'username': '', 'password': ''},
-    session_storage_variables=['device_id', 'access_token', 'refresh_token', 'expires'],
+    session_settings={'username': '', 'password': '', 'metadata_cache': True, 'metadata_cache_size_mb': 256,
+                      'prefetch_track_data': True, 'ranged_download_connections': 0, 'collect_metrics': False,
+                      'cover_cache_size_mb': 256, 'prefetch_album_lyrics': False},
+    session_storage_variables=['device_id', 'access_token', 'refresh_token', 'expires', 'account_rights'],
     netlocation_constant='bugs',
     test_url='https://music.bugs.co.kr/track/5311931'
 )
 
+# get the bitrate based on the highest quality, why has aac256 not 256kbit/s?!
+quality_bitrates = {
+    'flac24': 2116,
+    'flac': 1411,
+    'aac256': 320,
+    '320k': 320,
+    'aac': 128,
+}
+
+# get the codec based on the highest quality
+quality_codecs = {
+    'flac24': CodecEnum.FLAC,
+    'flac': CodecEnum.FLAC,
+    'aac256': CodecEnum.AAC,
+    '320k': CodecEnum.MP3,
+    'aac': CodecEnum.AAC,
+}
+
+# https://en.wikipedia.org/wiki/Audio_bit_depth#cite_ref-1
+quality_bit_depths = {
+    'flac24': 24,
+    'flac': 16
+}
+
+
+@dataclass
+class PreparedTrack:
+    # futures of the concurrently started API calls for one track, stream resolves to (quality, stream data)
+    track: Future
+    album: Future
+    lyrics: Future
+    stream: Future
+
 
 class ModuleInterface:
     # noinspection PyTypeChecker
     def __init__(self, module_controller: ModuleController):
+        init_start = time.perf_counter()
+
         self.cover_size = module_controller.orpheus_options.default_cover_options.resolution
         self.exception = module_controller.module_error
         self.oprinter = module_controller.printer_controller
@@ -39,6 +92,55 @@ class ModuleInterface:
 
         self.session = BugsApi()
 
+        # persistent metadata cache, survives crashes so a re-run of a large job does not repeat every call
+        settings = module_controller.module_settings
+        if settings.get('metadata_cache', True):
+            self.session.cache = ResponseCache(os.path.join(module_controller.data_folder, 'metadata_cache.db'),
+                                               max_size=int(settings.get('metadata_cache_size_mb', 256)) * 1024 * 1024)
+
+        # page size and number of prefetched pages for the paged artist listings
+        self.page_size = 100
+        self.page_prefetch = 2
+
+        # per endpoint request statistics, see get_stats()
+        if settings.get('collect_metrics', False):
+            self.session.enable_metrics()
+
+        # album records shared between get_album_info, get_track_info and get_track_cover
+        self.albums = SingleFlightLRU(maxsize=256)
+        # album level tags and cover url shared by all TrackInfos of an album, see _get_album_base()
+        self.album_bases = SingleFlightLRU(maxsize=256)
+        # (quality_tier, bitrates, needs_premium_flac, flac_premium): selected quality, see _select_quality()
+        self.quality_table = {}
+
+        # matches tracks from other services, also used to rank search(track_info=...) results
+        self.matcher = TrackMatcher(self.session)
+
+        # new releases of monitored artists, created on first use, see sync_artists()
+        self._artist_sync = None
+
+        # get_track_info requests the lyrics, stream url and missing track/album data concurrently and hands the
+        # results to get_track_cover, get_track_lyrics and get_track_download
+        self.prefetch_track_data = settings.get('prefetch_track_data', True)
+        # get_album_info requests the lyrics of all album tracks in the background, only useful if lyrics are saved
+        self.prefetch_album_lyrics = settings.get('prefetch_album_lyrics', False)
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='bugs')
+        self.prepared_tracks = SingleFlightLRU(maxsize=64)
+        # formatted lyrics, with prefetch_album_lyrics get_album_info already requests the lyrics of all album tracks on
+        # its own small pool, so the per track requests of self.executor never wait behind a whole album of lyrics
+        self.lyrics = SingleFlightLRU(maxsize=512)
+        self.lyrics_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='bugs-lyrics')
+
+        # download the streams with several parallel Range requests instead of returning the url, 0 disables it
+        self.download_folder = os.path.join(module_controller.data_folder, 'downloads')
+        connections = int(settings.get('ranged_download_connections', 0))
+        self.downloader = RangedDownloader(connections=connections) if connections > 0 else None
+
+        # album covers on disk shared by all tracks of an album, created on first use so a start does not scan the
+        # covers folder, see get_track_cover_file()
+        self._covers = None
+        self._covers_lock = threading.Lock()
+
         # generate device_id and save it in the temporary settings
         device_id = module_controller.temporary_settings_controller.read('device_id')
         if not device_id:
@@ -53,66 +155,468 @@ class ModuleInterface:
             'expires': module_controller.temporary_settings_controller.read('expires')
         }
 
+        # how long the subscription from the API is trusted before it is checked again
+        self.account_rights_ttl = timedelta(hours=24)
         self.account_flac_premium = False
         self.session.set_session(session)
+        # a token which expires or is rejected during a long run is refreshed like an expired one at startup
+        self.session.token_refresher = self.refresh_token
+
+        # the session is validated on the first call which needs it, see _ensure_session()
+        self._session_lock = threading.Lock()
+        self._session_ready = False
+        # only one thread refreshes the token or logs in again during a run, see refresh_token()
+        self._refresh_lock = threading.Lock()
+
+        # seconds from the start of __init__ until the module is constructed and until the session is ready
+        self.startup_timings = {'init': time.perf_counter() - init_start, 'ready': None}
+        self._init_start = init_start
+
+    def _ensure_session(self):
+        # validates the stored session exactly once, other threads wait until it is done
+        if self._session_ready:
+            return
+
+        with self._session_lock:
+            if self._session_ready:
+                return
+
+            expires = self.session.expires
+            if self.session.access_token and expires and expires > datetime.now():
+                self.valid_account()
+            elif self.session.refresh_token:
+                # access token expired, get new refresh token
+                self.refresh_token()
+
+            self._session_ready = True
+            self.startup_timings['ready'] = time.perf_counter() - self._init_start
+            logging.debug(f'Bugs: session ready after {self.startup_timings["ready"]:.3f}s')
+
+    def _save_session(self):
+        # save the new access_token, refresh_token and expires in the temporary settings
+        self.module_controller.temporary_settings_controller.set('access_token', self.session.access_token)
+        self.module_controller.temporary_settings_controller.set('refresh_token', self.session.refresh_token)
+        self.module_controller.temporary_settings_controller.set('expires', self.session.expires)
 
-        if session['access_token'] and session['expires'] > datetime.now():
-            self.valid_account()
+    def refresh_token(self, stale_access_token: str = None):
+        # stale_access_token is the token a failed request was sent with, if another thread already replaced it
+        # nothing is done, so many workers with an expired token only refresh it once
+        with self._refresh_lock:
+            if stale_access_token is not None and self.session.access_token != stale_access_token:
+                return
 
-        if session['refresh_token'] and datetime.now() > session['expires']:
-            # access token expired, get new refresh token
-            self.refresh_token()
+            logging.debug(f'Bugs: access_token expired, getting a new one')
 
-    def refresh_token(self):
-        logging.debug(f'Bugs: access_token expired, getting a new one')
+            # get a new access_token and refresh_token from the API
+            try:
+                self.session.refresh()
+            except (ConnectionError, requests.RequestException, ValueError):
+                # the refresh_token is not valid anymore, fall back to a full login
+                settings = self.module_controller.module_settings
+                if not settings.get('username') or not settings.get('password'):
+                    raise self.exception('Session expired, please enter your username and password')
 
-        # get a new access_token and refresh_token from the API
-        # TODO: implement refresh token oauth flow
-        # refresh_data = self.session.refresh()
+                self.login(settings.get('username'), settings.get('password'))
+                return
+
+            self._save_session()
+            self.valid_account()
 
-        # save the new access_token, refresh_token and expires in the temporary settings
-        self.module_controller.temporary_settings_controller.set('access_token', self.session.access_token)
-        self.module_controller.temporary_settings_controller.set('refresh_token', self.session.refresh_token)
-        self.module_controller.temporary_settings_controller.set('expires', self.session.expires)
-            
     def login(self, email: str, password: str):
         logging.debug(f'Bugs: no session found, login')
         self.session.auth(email, password)
 
-        self.valid_account()
+        # a new login always checks the subscription again
+        self.valid_account(force=True)
 
-        # save the new access_token, refresh_token and expires in the temporary settings
-        self.module_controller.temporary_settings_controller.set('access_token', self.session.access_token)
-        self.module_controller.temporary_settings_controller.set('refresh_token', self.session.refresh_token)
-        self.module_controller.temporary_settings_controller.set('expires', self.session.expires)
+        self._save_session()
+        self._session_ready = True
+        if self.startup_timings['ready'] is None:
+            self.startup_timings['ready'] = time.perf_counter() - self._init_start
+
+    def valid_account(self, force: bool = False):
+        # the account rights are stored in the temporary settings, so a warm start does not need the API at all
+        account_rights = self.module_controller.temporary_settings_controller.read('account_rights')
+        if not force and account_rights and account_rights.get('checked') + self.account_rights_ttl > datetime.now():
+            self._set_account_rights(account_rights)
+            return
 
-    def valid_account(self):
         # get the subscription from the API and check if it's at least a "Streaming" subscription
         account_data = self.session.get_account()
         if account_data:
             # fallback if no subscription exists
             subscription = account_data.get('stream') or {}
-            # save the "Premium" subscription status
-            self.account_flac_premium = subscription.get('is_flac_premium')
+            account_rights = {
+                # save the "Premium" subscription status
+                'flac_premium': subscription.get('is_flac_premium'),
+                # also check subscription.get('is_premium')?
+                'streaming': bool(subscription.get('is_cellular_flac') or subscription.get('is_premium')),
+                'checked': datetime.now()
+            }
+            self.module_controller.temporary_settings_controller.set('account_rights', account_rights)
+            self._set_account_rights(account_rights)
+
+    def _set_account_rights(self, account_rights: dict):
+        self.account_flac_premium = account_rights.get('flac_premium')
+        if not account_rights.get('streaming'):
+            raise self.exception('You need a Streaming ("Phone only"/Premium) subscription to use this module')
+
+    def get_stats(self, prometheus: bool = False):
+        # request statistics as dict or in the Prometheus text format, None if collect_metrics is disabled
+        if not self.session.metrics:
+            return None
+        return self.session.metrics.prometheus() if prometheus else self.session.metrics.snapshot()
+
+    def _get_album_data(self, album_id: str or int) -> dict:
+        # fetches the "album" result once, concurrent callers for the same album wait for the same request
+        album_id = int(album_id)
+        return self.albums.get(album_id, lambda: self.session.get_album(album_id)[0].get('album').get('result'))
+
+    def prepare_track(self, track_id: str or int, quality_tier: QualityEnum, data=None) -> PreparedTrack:
+        # starts all API calls for a track at once, the track/album chain only waits if the track data is missing
+        if data is None:
+            data = {}
+
+        def prepare():
+            if track_id in data:
+                track = self.executor.submit(TrackRecord.from_api, data[track_id])
+            else:
+                track = self.executor.submit(self._get_track_record, track_id)
+
+            def get_album():
+                album_id = track.result().album_id
+                return data[album_id] if album_id in data else self._get_album_data(album_id)
+
+            def get_stream():
+                track_data = track.result()
+                highest_quality = self._select_quality(track_data, quality_tier)
+                # do not request a stream url for tracks which are not streamable anyway
+                if not track_data.streamable:
+                    return highest_quality, None
+                return highest_quality, self.session.get_stream(track_id, highest_quality)
+
+            return PreparedTrack(
+                track=track,
+                album=self.executor.submit(get_album),
+                lyrics=self.executor.submit(self._get_lyrics, track_id),
+                stream=self.executor.submit(get_stream)
+            )
+
+        return self.prepared_tracks.get(str(track_id), prepare)
+
+    def _get_track_record(self, track_id: str or int) -> TrackRecord:
+        return TrackRecord.from_api(self.session.get_track(track_id)[0].get('track').get('result'))
 
-            # also check subscription.get('is_premium')?
-            if not subscription.get('is_cellular_flac') and not subscription.get('is_premium'):
-                raise self.exception('You need a Streaming ("Phone only"/Premium) subscription to use this module')
+    def _select_quality(self, track_data: TrackRecord, quality_tier: QualityEnum) -> str:
+        key = (quality_tier, track_data.bitrates, track_data.flac_premium, bool(self.account_flac_premium))
+
+        # only a handful of different combinations exist, so every one is only computed once
+        highest_quality = self.quality_table.get(key)
+        if highest_quality is None:
+            highest_quality = self.quality_table[key] = self._compute_quality(*key)
+        return highest_quality
+
+    def _compute_quality(self, quality_tier: QualityEnum, bitrates: frozenset, needs_premium_flac: bool,
+                         flac_premium: bool) -> str:
+        # set default highest_quality to lowest (aac)
+        highest_quality = self.quality_order[-1]
+        # iterate over the quality order and check if the track is available in that quality
+        for quality in self.quality_order[self.quality_order.index(self.quality_parse[quality_tier]):]:
+            # if the track is available in that quality, set it as the highest quality and break
+            if quality in bitrates:
+                # if the track requires "Premium" to stream the flac file and the user do not have premium,
+                # skip the flac
+                if 'flac' in quality and needs_premium_flac and not flac_premium:
+                    continue
+
+                highest_quality = quality
+                break
+
+        return highest_quality
+
+    def _get_album_base(self, album_data: dict) -> tuple:
+        # (release_year, Tags, cover_url) of an album, the same for all of its tracks
+        def build():
+            release_ymd = album_data.get('release_ymd')
+            release_year = release_ymd[:4] if release_ymd else None
+
+            release_date = None
+            if release_ymd:
+                # add a day if the day is missing from the YYYYMM date
+                release_date = f'{release_ymd[:4]}-{release_ymd[4:6]}-{release_ymd[6:8] or "01"}'
+
+            genres = album_data.get('genres')
+            tags = Tags(
+                album_artist=album_data.get('artists')[0].get('artist_nm'),
+                total_tracks=album_data.get('track_count'),
+                total_discs=album_data.get('disc_count'),
+                genres=[genre.get('svc_nm') for genre in genres] if genres else None,
+                release_date=release_date,
+                copyright=f'© {release_year} '
+                          f'{album_data.get("labels")[0].get("label_nm")}' if album_data.get("labels") else None,
+            )
+            cover_url = self._generate_artwork_url(album_data.get('image').get('path'), size=self.cover_size)
+            return release_year, tags, cover_url
+
+        return self.album_bases.get(album_data.get('album_id'), build)
+
+    def _build_track_info(self, track_id: int, track_data: TrackRecord, album_data: dict,
+                          quality_tier: QualityEnum) -> TrackInfo:
+        release_year, album_tags, cover_url = self._get_album_base(album_data)
+
+        error = None
+        if not track_data.streamable:
+            error = f'Track "{track_data.title}" is not streamable!'
+
+        highest_quality = self._select_quality(track_data, quality_tier)
+
+        return TrackInfo(
+            name=track_data.title,
+            album=album_data.get('title'),
+            album_id=album_data.get('album_id'),
+            artists=track_data.artist_names,
+            artist_id=track_data.artist_id,
+            release_year=release_year,
+            bitrate=quality_bitrates.get(highest_quality),
+            duration=self.convert_duration_str_to_secs(track_data.len) if track_data.len else None,
+            sample_rate=44.1,
+            bit_depth=quality_bit_depths.get(highest_quality),
+            cover_url=cover_url,
+            # animated_cover_url=self._generate_animated_artwork_url(album_data.get('live_image').get('path')),
+            # the cached album Tags are shared by all tracks, so every track gets its own copy of the mutable fields
+            tags=replace(album_tags, track_number=track_data.track_no, disc_number=track_data.disc_no,
+                         replay_gain=track_data.track_gain,
+                         genres=list(album_tags.genres) if album_tags.genres is not None else None,
+                         extra_tags=dict(album_tags.extra_tags)),
+            codec=quality_codecs.get(highest_quality),
+            download_extra_kwargs={'track_id': track_id, 'quality_tier': highest_quality},
+            error=error
+        )
+
+    def get_album_track_infos(self, album_data: dict, tracks: list, quality_tier: QualityEnum) -> dict:
+        # all TrackInfos of an album from the "album" and "album_track" results at once, {track_id: TrackInfo}
+        self._ensure_session()
+        records = [TrackRecord.from_api(t) for t in tracks]
+        return {r.track_id: self._build_track_info(r.track_id, r, album_data, quality_tier) for r in records}
+
+    def resolve_albums(self, album_ids: list) -> dict:
+        # fetches all missing album records and returns {album_id: album record}. The batched multi invoke requests go
+        # through the metadata cache, rate limiter and circuit breaker of the session
+        album_ids = list(dict.fromkeys(int(i) for i in album_ids))
+        # the results are collected directly, more albums than the LRU holds must not be requested twice
+        albums = {i: self.albums.peek(i) for i in album_ids}
+        missing = [i for i, album in albums.items() if album is None]
+
+        if missing:
+            for album_id, album_data in self.session.get_albums(missing).items():
+                albums[album_id] = album_data[0].get('album').get('result')
+                if albums[album_id] is not None:
+                    self.albums.put(album_id, albums[album_id])
+
+        return albums
+
+    def resolve_manifest(self, urls: list, output_path: str, quality_tier: QualityEnum, batch_size: int = 200) -> dict:
+        # resolves many track, album and artist urls to a JSONL manifest with one line per track, see manifest.py. An
+        # existing manifest is continued, returns the number of sources, skipped sources, tracks and errors
+        self._ensure_session()
+        counts = {'sources': 0, 'skipped': 0, 'tracks': 0, 'errors': 0}
+
+        sources, invalid = [], []
+        for url in urls:
+            parsed = parse_url(url)
+            if parsed:
+                sources.append(f'{parsed[0]}:{parsed[1]}')
+            else:
+                invalid.append(url)
+        sources = list(dict.fromkeys(sources))
+        invalid = list(dict.fromkeys(invalid))
+
+        with ManifestWriter(output_path) as writer:
+            pending = [s for s in sources if s not in writer.done]
+            counts['sources'], counts['skipped'] = len(sources), len(sources) - len(pending)
+
+            invalid = [url for url in invalid if url not in writer.done]
+            if invalid:
+                writer.write([{'source': url, 'track_id': None, 'error': 'Not a Bugs! track, album or artist url'}
+                              for url in invalid])
+                writer.complete(invalid)
+                counts['errors'] += len(invalid)
+
+            for i in range(0, len(pending), batch_size):
+                chunk = pending[i:i + batch_size]
+                entries = self._resolve_manifest_chunk(chunk, quality_tier)
+                writer.write(entries)
+                writer.complete(chunk)
+
+                counts['tracks'] += sum(1 for e in entries if e.get('track_id'))
+                counts['errors'] += sum(1 for e in entries if e.get('error'))
+                logging.debug(f'Bugs: manifest {min(i + batch_size, len(pending))}/{len(pending)} urls resolved')
+
+        return counts
+
+    def _resolve_manifest_chunk(self, sources: list, quality_tier: QualityEnum) -> list:
+        ids = {'track': [], 'album': [], 'artist': []}
+        for source in sources:
+            kind, _, source_id = source.partition(':')
+            ids[kind].append(int(source_id))
+
+        # the tracks (batched multi invoke), the album track lists (batched) and the artist discographies
+        # (concurrently) are requested at the same time
+        tracks = self.executor.submit(self.session.get_tracks, ids['track'])
+        album_tracks = self.executor.submit(self.session.get_albums_tracks, ids['album'])
+        artists = {i: self.executor.submit(self.session.get_artist_full, i, page_size=self.page_size)
+                   for i in ids['artist']}
+
+        # {source: [TrackRecord]}, a source which failed is in errors instead and gets an error entry, the rest of the
+        # chunk is still written
+        records, errors = {}, {}
+
+        def error_message(e: Exception) -> str:
+            return f'{type(e).__name__}: {e}'
+
+        def collect(source: str, get_records):
+            try:
+                records[source] = get_records()
+            except Exception as e:
+                logging.exception(f'Bugs: manifest source {source} failed')
+                errors[source] = error_message(e)
+
+        def batch_results(future, kind: str) -> dict:
+            try:
+                return future.result()
+            except Exception as e:
+                # the whole batched request failed, every source of this kind gets the error
+                logging.exception(f'Bugs: manifest {kind} lookup failed')
+                errors.update({f'{kind}:{i}': error_message(e) for i in ids[kind]})
+                return {}
+
+        def track_records(result) -> list:
+            track = result[0].get('track').get('result') if result else None
+            return [TrackRecord.from_api(track)] if track else []
+
+        def album_track_records(result) -> list:
+            tracks_list = (result[0].get('album_track') or {}).get('list') if result else None
+            return [TrackRecord.from_api(t) for t in tracks_list or []]
+
+        for track_id, result in batch_results(tracks, 'track').items():
+            collect(f'track:{track_id}', lambda: track_records(result))
+        for album_id, result in batch_results(album_tracks, 'album').items():
+            collect(f'album:{album_id}', lambda: album_track_records(result))
+        for artist_id, future in artists.items():
+            collect(f'artist:{artist_id}', lambda: [TrackRecord.from_api(t) for t in future.result().get('tracks')])
+
+        # every album is only requested once, no matter how many tracks of it are in the manifest
+        album_ids = {r.album_id for rs in records.values() for r in rs if r.album_id}
+        try:
+            albums, album_error = self.resolve_albums(album_ids | set(ids['album'])), None
+        except Exception as e:
+            # every track still gets its own entry, with the album error
+            logging.exception('Bugs: manifest albums failed')
+            albums, album_error = {}, error_message(e)
+
+        entries = []
+        for source in sources:
+            if source in errors:
+                entries.append({'source': source, 'track_id': None, 'error': errors[source]})
+                continue
+            if not records.get(source):
+                entries.append({'source': source, 'track_id': None, 'error': 'Not found or empty'})
+                continue
+
+            for record in records[source]:
+                if album_error:
+                    entries.append({'source': source, 'track_id': record.track_id, 'album_id': record.album_id,
+                                    'error': album_error})
+                    continue
+                try:
+                    entries.append(self._manifest_entry(source, record, albums.get(record.album_id), quality_tier))
+                except Exception as e:
+                    logging.exception(f'Bugs: manifest track {record.track_id} failed')
+                    entries.append({'source': source, 'track_id': record.track_id, 'album_id': record.album_id,
+                                    'error': error_message(e)})
+
+        return entries
+
+    def _manifest_entry(self, source: str, record: TrackRecord, album_data: dict, quality_tier: QualityEnum) -> dict:
+        entry = {'source': source, 'track_id': record.track_id, 'album_id': record.album_id}
+        if album_data is None:
+            return dict(entry, name=record.title, error=f'Album {record.album_id} not found')
+
+        track_info = self._build_track_info(record.track_id, record, album_data, quality_tier)
+        return dict(
+            entry,
+            name=track_info.name,
+            artists=track_info.artists,
+            album=track_info.album,
+            quality=track_info.download_extra_kwargs.get('quality_tier'),
+            codec=track_info.codec.name if track_info.codec else None,
+            bitrate=track_info.bitrate,
+            bit_depth=track_info.bit_depth,
+            error=track_info.error,
+        )
+
+    def preflight(self, tracks, quality_tier: QualityEnum) -> dict:
+        # availability and selected quality of many tracks from listing data without any request per track: API track
+        # results or TrackRecords, e.g. the values of the track_extra_kwargs data. Returns {'tracks': [row], 'counts':
+        # {...}}, premium_limited rows would get a better quality with a "Premium" subscription
+        self._ensure_session()
+
+        # tracks with the same bitrates and premium flag always get the same result, so it is only computed once
+        profiles = {}
+
+        def profile(record: TrackRecord) -> dict:
+            key = (record.bitrates, record.flac_premium)
+            if key not in profiles:
+                quality = self._select_quality(record, quality_tier)
+                premium_quality = self._compute_quality(quality_tier, record.bitrates, record.flac_premium, True)
+                profiles[key] = {
+                    'quality': quality,
+                    'codec': quality_codecs.get(quality).name,
+                    'bitrate': quality_bitrates.get(quality),
+                    'bit_depth': quality_bit_depths.get(quality),
+                    'premium_limited': premium_quality != quality,
+                }
+            return profiles[key]
+
+        rows = []
+        counts = Counter()
+        qualities = Counter()
+        for record in (TrackRecord.from_api(t) for t in tracks):
+            # albums in the extra_kwargs data are skipped
+            if not record.track_id:
+                continue
+
+            row = {'track_id': record.track_id, 'album_id': record.album_id, 'title': record.title,
+                   'streamable': record.streamable, **profile(record)}
+            rows.append(row)
+
+            counts['total'] += 1
+            counts['streamable' if record.streamable else 'not_streamable'] += 1
+            if record.streamable:
+                qualities[row['quality']] += 1
+                counts['premium_limited'] += row['premium_limited']
+
+        return {'tracks': rows, 'counts': {'total': 0, 'streamable': 0, 'not_streamable': 0, 'premium_limited': 0,
+                                           **counts, 'qualities': dict(qualities)}}
+
+    def preflight_album(self, album_id: str or int, quality_tier: QualityEnum) -> dict:
+        # from the (cached) album track list, one request for the whole album at most, decoded while it is received
+        return self.preflight(self.session.stream_album_tracks(album_id), quality_tier)
+
+    def preflight_artist(self, artist_id: str or int, quality_tier: QualityEnum) -> dict:
+        # from the (cached) artist track listing, one request per page of self.page_size tracks at most
+        artist_data = self.session.get_artist_full(artist_id, page_size=self.page_size, prefetch=self.page_prefetch)
+        return self.preflight(artist_data.get('tracks'), quality_tier)
 
     @staticmethod
     def convert_duration_str_to_secs(duration: str) -> int:
         # convert MM:SS (string) to seconds (int)
-        return sum(int(x) * 60 ** i for i, x in enumerate(reversed(duration.split(':'))))
+        return convert_duration_str_to_secs(duration)
 
     @staticmethod
     def _generate_artwork_url(cover_path: str, size: int, max_size=3000):
-        # not the best idea, but it rounds the self.cover_size to the nearest number in supported_sizes, 3001 is needed
-        # for the "uncompressed" cover
-        supported_sizes = [75, 140, 200, 350, 500, 1000, 1280, 1400, 2000, 3001]
-        best_size = min(supported_sizes, key=lambda x: abs(x - size))
-        # return "uncompressed" cover if self.cover_resolution > max_size
-        cover_size = best_size if best_size <= max_size else 'original'
-        return f'https://image.bugsm.co.kr/album/images/{cover_size}{cover_path}'
+        # rounds the size to the nearest supported size, "uncompressed" cover if the size > max_size
+        return artwork_url(cover_path, size, max_size)
 
     @staticmethod
     def _generate_animated_artwork_url(live_cover_path: str):
@@ -122,98 +626,135 @@ class ModuleInterface:
         return f'https://image.bugsm.co.kr/livealbum/images/original/{live_cover_path}'
 
     def search(self, query_type: DownloadTypeEnum, query: str, track_info: TrackInfo = None, limit: int = 20):
-        if query_type is DownloadTypeEnum.playlist:
-            raise self.exception(f'Query type "{query_type.name}" is not supported!')
+        if track_info and query_type is DownloadTypeEnum.track:
+            # best matching track first
+            candidates = list(self.session.iter_search(query, query_type.name, page_size=50, limit=limit))
+            return [self._parse_search_result(query_type, c) for _, c in self.matcher.rank(track_info, candidates)]
 
-        results = self.session.get_search(query)[0].get('get_search_combine').get('result')
+        return list(self.iter_search(query_type, query, limit=limit))
 
-        items = []
-        for i in results.get(query_type.name).get('list', []) or []:
-            additional = []
-            duration = None
-            if query_type is DownloadTypeEnum.track:
-                name = i.get('track_title')
-                result_id = i.get('track_id')
-
-                artists = [a.get('artist_nm') for a in i.get('artists')]
-                year = i.get('album').get('release_ymd')[:4] if i.get('album').get('release_ymd') else None
-                duration = self.convert_duration_str_to_secs(i.get('len')) if i.get('len') else None
-
-                additional.append('LOSSLESS') if i.get('rights').get('download_flac').get('service_flac_yn') else None
-            elif query_type is DownloadTypeEnum.album:
-                name = i.get('title')
-                result_id = i.get('album_id')
-
-                artists = [j.get('artist_nm') for j in i.get('artists')]
-                year = i.get('release_ymd')[:4] if i.get('release_ymd') else None
-            elif query_type is DownloadTypeEnum.artist:
-                name = i.get('artist_nm')
-                result_id = i.get('artist_id')
-
-                artists = None
-                year = None
-            else:
-                raise self.exception(f'Query type "{query_type.name}" is not supported!')
+    def match_tracks(self, track_infos: list, min_confidence: float = 0.6) -> list:
+        # matches many TrackInfos from other services at once, returns a MatchResult with confidence for each one
+        return self.matcher.match_many(track_infos, min_confidence=min_confidence)
 
-            item = SearchResult(
-                name=name,
-                artists=artists,
-                year=year,
-                duration=duration,
-                result_id=result_id,
-                additional=additional if additional != [] else None,
-                extra_kwargs={'data': {i.get('id'): i}}
-            )
+    def iter_search(self, query_type: DownloadTypeEnum, query: str, limit: int = 20, page_size: int = 50):
+        # only requests the results of the wanted category, page by page, while they are consumed
+        if query_type not in {DownloadTypeEnum.track, DownloadTypeEnum.album, DownloadTypeEnum.artist}:
+            raise self.exception(f'Query type "{query_type.name}" is not supported!')
+
+        for i in self.session.iter_search(query, query_type.name, page_size=page_size, limit=limit):
+            yield self._parse_search_result(query_type, i)
 
-            items.append(item)
+    def search_multi(self, query_types: list, query: str, limit: int = 20) -> dict:
+        # all categories from one combined request, returns {query_type: [SearchResult]}
+        results = self.session.get_search(query)[0].get('get_search_combine').get('result')
 
-        return items
+        return {query_type: [self._parse_search_result(query_type, i)
+                             for i in (results.get(query_type.name).get('list', []) or [])[:limit]]
+                for query_type in query_types}
+
+    def _parse_search_result(self, query_type: DownloadTypeEnum, i: dict) -> SearchResult:
+        additional = []
+        duration = None
+        if query_type is DownloadTypeEnum.track:
+            name = i.get('track_title')
+            result_id = i.get('track_id')
+
+            artists = [a.get('artist_nm') for a in i.get('artists')]
+            year = i.get('album').get('release_ymd')[:4] if i.get('album').get('release_ymd') else None
+            duration = self.convert_duration_str_to_secs(i.get('len')) if i.get('len') else None
+
+            additional.append('LOSSLESS') if i.get('rights').get('download_flac').get('service_flac_yn') else None
+        elif query_type is DownloadTypeEnum.album:
+            name = i.get('title')
+            result_id = i.get('album_id')
+
+            artists = [j.get('artist_nm') for j in i.get('artists')]
+            year = i.get('release_ymd')[:4] if i.get('release_ymd') else None
+        elif query_type is DownloadTypeEnum.artist:
+            name = i.get('artist_nm')
+            result_id = i.get('artist_id')
+
+            artists = None
+            year = None
+        else:
+            raise self.exception(f'Query type "{query_type.name}" is not supported!')
+
+        return SearchResult(
+            name=name,
+            artists=artists,
+            year=year,
+            duration=duration,
+            result_id=result_id,
+            additional=additional if additional != [] else None,
+            # only track results are read from the data by get_track_info and get_track_cover
+            extra_kwargs={'data': {result_id: TrackRecord.from_api(i)}} if query_type is DownloadTypeEnum.track else {}
+        )
 
     def get_playlist_info(self, playlist_id: str):
         self.exception(f'Bugs does not support playlists?')
 
     def get_artist_info(self, artist_id: str, get_credited_albums: bool, data=None) -> ArtistInfo:
-        artist_data = self.session.get_artist(artist_id)
-        # get the "artist" and "artist_image" data from the multi-call request, artist is always 0 and artist_image 1
-        artist_info = artist_data[0].get('artist').get('result')
+        # artist, images, tracks, albums and compilations in one request, only further pages need more requests
+        artist_data = self.session.get_artist_full(artist_id, include_compilations=get_credited_albums,
+                                                   page_size=self.page_size, prefetch=self.page_prefetch)
+        artist_info = artist_data.get('artist')
         # TODO: download all artist pictures?
-        artist_images = artist_data[1].get('artist_image').get('list')
-
-        # get all the artist tracks
-        artist_tracks_data = self.session.get_artist_tracks(artist_id)
-        artist_tracks = artist_tracks_data[0].get('artist_track').get('list')
+        artist_images = artist_data.get('artist_image')
 
-        # get all the artist albums
-        artist_albums_data = self.session.get_artist_albums(artist_id)
-        artist_albums = artist_albums_data[0].get('artist_album_filter_release').get('list')
-
-        # get all the compilation albums
-        if get_credited_albums:
-            artist_compilations_data = self.session.get_artist_compilation_albums(artist_id)
-            artist_albums += artist_compilations_data[0].get('artist_album_filter_joincompil').get('list')
+        artist_tracks = artist_data.get('tracks')
+        artist_albums = artist_data.get('albums') + artist_data.get('compilations', [])
 
         return ArtistInfo(
             name=artist_info.get('artist_nm'),
             tracks=[t.get('track_id') for t in artist_tracks],
-            track_extra_kwargs={'data': {t.get('track_id'): t for t in artist_tracks}},
+            # one shared mapping of compact records, get_album_info does not read any album data
+            track_extra_kwargs={'data': {t.get('track_id'): TrackRecord.from_api(t) for t in artist_tracks}},
             albums=[a.get('album_id') for a in artist_albums],
-            album_extra_kwargs={'data': {a.get('album_id'): a for a in artist_albums}},
         )
 
+    def sync_artists(self, artist_ids: list, get_credited_albums: bool = False) -> dict:
+        # only the albums and tracks released since the last sync of every artist, returns {artist_id: ArtistInfo}.
+        # The first sync of an artist only stores its watermark and returns an empty ArtistInfo
+        if self._artist_sync is None:
+            store = WatermarkStore(os.path.join(self.module_controller.data_folder, 'artist_sync.db'))
+            self._artist_sync = ArtistSync(self.session, store)
+
+        artist_infos = {}
+        for artist_id, result in self._artist_sync.sync_many(artist_ids,
+                                                             include_compilations=get_credited_albums).items():
+            albums, tracks = result.get('albums'), result.get('tracks')
+            # the artist itself is not requested, take the name from one of the new albums
+            name = next((a.get('artist_nm') for album in albums for a in album.get('artists') or []
+                         if a.get('artist_id') == artist_id), str(artist_id))
+
+            artist_infos[artist_id] = ArtistInfo(
+                name=name,
+                tracks=[t.get('track_id') for t in tracks],
+                track_extra_kwargs={'data': {t.get('track_id'): TrackRecord.from_api(t) for t in tracks}},
+                albums=[a.get('album_id') for a in albums],
+            )
+
+        return artist_infos
+
     def get_album_info(self, album_id: str, data=None) -> AlbumInfo:
         # check if album is already in album cache, add it
         if data is None:
             data = {}
 
+        # the track list is pending in the batcher while the album is requested, so both are sent as one request
+        tracks_data = self.session.submit_album_tracks(album_id)
+
         # always get the album data from the API, because the cache is missing a lot of tags
-        album_data = self.session.get_album(album_id)
-        album_info = album_data[0].get('album').get('result')
+        album_info = self._get_album_data(album_id)
 
-        tracks_data = self.session.get_album_tracks(album_id)
-        tracks = tracks_data[0].get('album_track').get('list')
+        tracks = tracks_data.result()[0].get('album_track').get('list')
 
-        # add all the tracks and album to the cache
-        cache = {'data': {track.get('track_id'): track for track in tracks}}
+        if self.prefetch_album_lyrics:
+            self.prefetch_lyrics([t.get('track_id') for t in tracks])
+
+        # add all the tracks and album to the cache, the album record is shared with self.albums
+        cache = {'data': {track.get('track_id'): TrackRecord.from_api(track) for track in tracks}}
         cache['data'].update({album_id: album_info})
 
         return AlbumInfo(
@@ -232,140 +773,117 @@ class ModuleInterface:
         if data is None:
             data = {}
 
-        track_data = data[track_id] if track_id in data else self.session.get_track(
-            track_id)[0].get('track').get('result')
-
-        album_id = track_data.get('album').get('album_id')
-        album_data = data[album_id] if album_id in data else self.session.get_album(
-            album_id)[0].get('album').get('result')
-
-        release_year = album_data.get('release_ymd')[:4] if album_data.get('release_ymd') else None
-
-        release_date = album_data.get('release_ymd') if album_data.get('release_ymd') else None
-        # add a day if the day is missing from the YYYYMM date
-        if len(release_date) == 6:
-            release_date += '01'
-        release_date = datetime.strptime(release_date, '%Y%m%d').strftime('%Y-%m-%d')
-
-        tags = Tags(
-            album_artist=album_data.get('artists')[0].get('artist_nm'),
-            track_number=track_data.get('track_no'),
-            total_tracks=album_data.get('track_count'),
-            disc_number=track_data.get('disc_no'),
-            total_discs=album_data.get('disc_count'),
-            genres=[genre.get('svc_nm') for genre in album_data.get('genres')] if album_data.get('genres') else None,
-            release_date=release_date,
-            copyright=f'© {release_year} '
-                      f'{album_data.get("labels")[0].get("label_nm")}' if album_data.get("labels") else None,
-            replay_gain=track_data.get('track_gain'),
-        )
+        # the quality selection depends on the subscription
+        self._ensure_session()
 
-        error = None
-        if not track_data.get('rights').get('streaming').get('service_yn'):
-            error = f'Track "{track_data.get("track_title")}" is not streamable!'
+        if self.prefetch_track_data:
+            prepared = self.prepare_track(track_id, quality_tier, data)
+            try:
+                track_data, album_data = prepared.track.result(), prepared.album.result()
+            except Exception:
+                # a failed lookup is not kept, the next call for this track starts all requests again
+                self.prepared_tracks.discard(str(track_id), prepared)
+                raise
+        else:
+            track_data = TrackRecord.from_api(data[track_id]) if track_id in data else self._get_track_record(track_id)
 
-        # check if "Premium" is required to stream the flac file
-        needs_premium_flac = track_data.get('rights').get('streaming').get('flac_premium_yn')
+            album_id = track_data.album_id
+            album_data = data[album_id] if album_id in data else self._get_album_data(album_id)
 
-        # set default highest_quality to lowest (aac)
-        highest_quality = self.quality_order[-1]
-        # iterate over the quality order and check if the track is available in that quality
-        for i in range(self.quality_order.index(self.quality_parse[quality_tier]), len(self.quality_order)):
-            quality = self.quality_order[i]
-            # if the track is available in that quality, set it as the highest quality and break
-            if quality in track_data.get('bitrates'):
-                # if the track requires "Premium" to stream the flac file and the user do not have premium,
-                # skip the flac
-                if 'flac' in quality and needs_premium_flac and not self.account_flac_premium:
-                    continue
-
-                highest_quality = quality
-                break
-
-        # get the bitrate based on the highest quality, why has aac256 not 256kbit/s?!
-        bitrate = {
-            'flac24': 2116,
-            'flac': 1411,
-            'aac256': 320,
-            '320k': 320,
-            'aac': 128,
-        }.get(highest_quality, None)
-
-        # get the codec based on the highest quality
-        codec = {
-            'flac24': CodecEnum.FLAC,
-            'flac': CodecEnum.FLAC,
-            'aac256': CodecEnum.AAC,
-            '320k': CodecEnum.MP3,
-            'aac': CodecEnum.AAC,
-        }.get(highest_quality, None)
-
-        # https://en.wikipedia.org/wiki/Audio_bit_depth#cite_ref-1
-        bit_depth = {
-            'flac24': 24,
-            'flac': 16
-        }.get(highest_quality, None)
-
-        track_info = TrackInfo(
-            name=track_data.get('track_title'),
-            album=album_data.get('title'),
-            album_id=album_data.get('album_id'),
-            artists=[a.get('artist_nm') for a in track_data.get('artists')],
-            artist_id=track_data.get('artists')[0].get('artist_id'),
-            release_year=release_year,
-            bitrate=bitrate,
-            duration=self.convert_duration_str_to_secs(track_data.get('len')) if track_data.get('len') else None,
-            sample_rate=44.1,
-            bit_depth=bit_depth,
-            cover_url=self._generate_artwork_url(album_data.get('image').get('path'), size=self.cover_size),
-            # animated_cover_url=self._generate_animated_artwork_url(album_data.get('live_image').get('path')),
-            tags=tags,
-            codec=codec,
-            download_extra_kwargs={'track_id': track_id, 'quality_tier': highest_quality},
-            error=error
-        )
-
-        return track_info
+        return self._build_track_info(track_id, track_data, album_data, quality_tier)
 
     def get_track_download(self, track_id: str or int, quality_tier: str) -> TrackDownloadInfo:
-        stream_data = self.session.get_stream(track_id, quality_tier)
+        self._ensure_session()
+
+        prepared = self.prepared_tracks.peek(str(track_id))
+        stream_data = None
+        if prepared and not prepared.stream.exception():
+            prefetched_quality, stream_data = prepared.stream.result()
+            # the stream url was prefetched for a different quality
+            if prefetched_quality != quality_tier:
+                stream_data = None
+
+        if stream_data is None:
+            stream_data = self.session.get_stream(track_id, quality_tier)
         if stream_data.get('state') != 'OK':
             raise self.exception('Requested quality tier is currently not available, try again later')
 
+        if self.downloader:
+            # the file name only depends on the track and quality, so an interrupted download can be resumed
+            os.makedirs(self.download_folder, exist_ok=True)
+            file_path = os.path.join(self.download_folder, f'{track_id}_{quality_tier}.part')
+
+            def resolve_url():
+                # the signed stream url expired during the download
+                new_stream_data = self.session.get_stream(track_id, quality_tier)
+                if new_stream_data.get('state') != 'OK':
+                    raise self.exception('Requested quality tier is currently not available, try again later')
+                return new_stream_data.get('url')
+
+            self.downloader.download(stream_data.get('url'), file_path, resolve_url=resolve_url)
+            return TrackDownloadInfo(download_type=DownloadEnum.TEMP_FILE_PATH, temp_file_path=file_path)
+
         return TrackDownloadInfo(download_type=DownloadEnum.URL, file_url=stream_data.get('url'))
 
     def get_track_cover(self, track_id: str, cover_options: CoverOptions, data=None) -> CoverInfo:
+        # Bugs only support JPG?
+        cover_url = self._generate_artwork_url(self._get_cover_path(track_id, data), size=cover_options.resolution)
+        return CoverInfo(url=cover_url, file_type=ImageFileTypeEnum.jpg)
+
+    def get_track_cover_file(self, track_id: str, cover_options: CoverOptions, data=None) -> str:
+        # local file of the cover, downloaded once per album and size for all tracks. OrpheusDL itself needs a url
+        # in the CoverInfo, this is for callers which can use a file directly
+        return self._get_covers().get(self._get_cover_path(track_id, data), cover_options.resolution)
+
+    def get_album_cover_file(self, album_id: str or int, size: int = None) -> str:
+        return self._get_covers().get(self._get_album_data(album_id).get('image').get('path'), size or self.cover_size)
+
+    def _get_covers(self) -> CoverCache:
+        with self._covers_lock:
+            if self._covers is None:
+                settings = self.module_controller.module_settings
+                self._covers = CoverCache(os.path.join(self.module_controller.data_folder, 'covers'),
+                                          max_size=int(settings.get('cover_cache_size_mb', 256)) * 1024 * 1024,
+                                          session=self.session.s)
+            return self._covers
+
+    def _get_cover_path(self, track_id: str, data=None) -> str:
         if data is None:
             data = {}
 
-        track_data = data[track_id] if track_id in data else self.session.get_track(
-            track_id)[0].get('track').get('result')
-        cover_path = track_data.get('album').get('image').get('path')
-
-        # Bugs only support JPG?
-        cover_url = self._generate_artwork_url(cover_path, size=cover_options.resolution)
-        return CoverInfo(url=cover_url, file_type=ImageFileTypeEnum.jpg)
+        prepared = self.prepared_tracks.peek(str(track_id))
+        if track_id in data:
+            track_data = TrackRecord.from_api(data[track_id])
+        elif prepared and not prepared.track.exception():
+            track_data = prepared.track.result()
+        else:
+            track_data = self._get_track_record(track_id)
+        # prefer the full album record if it was already fetched for this album
+        album = self.albums.peek(track_data.album_id)
+        return album.get('image').get('path') if album else track_data.album_image_path
 
     def get_track_lyrics(self, track_id: str or int) -> LyricsInfo:
-        # get lyrics data for current track id
+        # prefetched by get_album_info (prefetch_album_lyrics) or get_track_info (prefetch_track_data) if possible
+        return self._get_lyrics(track_id)
+
+    def _get_lyrics(self, track_id: str or int) -> LyricsInfo:
+        return self.lyrics.get(str(track_id), lambda: self._load_lyrics(track_id))
+
+    def prefetch_lyrics(self, track_ids: list):
+        # requests the lyrics of many tracks concurrently in the background, failed requests are repeated by
+        # get_track_lyrics, no more tracks than the cache can hold are prefetched
+        for track_id in list(dict.fromkeys(str(i) for i in track_ids))[:self.lyrics.maxsize]:
+            if track_id not in self.lyrics:
+                self.lyrics_executor.submit(self._get_lyrics, track_id)
+
+    def _load_lyrics(self, track_id: str or int) -> LyricsInfo:
         lyrics_data = self.session.get_lyrics(track_id)
 
         embedded, synced = None, None
         if lyrics_data.get('result'):
             if 'time' in lyrics_data.get('result'):
-                # only synced lyrics are available
-                lyrics = lyrics_data.get('result').get('time')
-                # get the synced lyrics in the right lrc format
-                lyrics = lyrics.replace("＃", "\n")
-                # split the lyrics by line and | into a list of [<time>, <line>]
-                lines_split = [line.split('|') for line in lyrics.splitlines()]
-                # finally, create the lrc string
-                synced = "\n".join(
-                    f'[{datetime.fromtimestamp(float(time)).strftime("%M:%S.%f")[0:-4]}]{line}'
-                    for time, line in lines_split)
-
-                # convert the synced lyrics to normal lyrics
-                embedded = "\n".join(f'{line}' for time_stamp, line in lines_split)
+                # only synced lyrics are available, convert them to lrc and to normal lyrics
+                synced, embedded = parse_time_lyrics(lyrics_data.get('result').get('time'))
             elif 'normal' in lyrics_data.get('result'):
                 # only embedded lyrics are available
                 embedded = lyrics_data.get('result').get('normal')
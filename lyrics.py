@@ -0,0 +1,25 @@
+def format_timestamp(seconds: float) -> str:
+    # [mm:ss.xx] without any date or timezone handling, minutes keep counting after one hour like in other LRC files
+    centiseconds = int(round(seconds * 100))
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    return f'[{minutes:02d}:{centiseconds // 100:02d}.{centiseconds % 100:02d}]'
+
+
+def parse_time_lyrics(lyrics: str) -> tuple:
+    # converts the "time" lyrics of the API, "<seconds>|<line>" separated by "＃", to (synced LRC, plain lyrics) in
+    # a single pass over the lines
+    synced, plain = [], []
+    for line in lyrics.replace('＃', '\n').splitlines():
+        timestamp, separator, text = line.partition('|')
+        if not separator:
+            # no timestamp at all, only keep the text
+            plain.append(line)
+            continue
+
+        try:
+            synced.append(format_timestamp(float(timestamp)) + text)
+        except ValueError:
+            synced.append(text)
+        plain.append(text)
+
+    return '\n'.join(synced), '\n'.join(plain)
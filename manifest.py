@@ -0,0 +1,147 @@
+"""Bulk resolver for lists of Bugs! URLs, writes one JSON line per resolved track.
+
+Run from the OrpheusDL directory, so the module can import utils.models and read config/settings.json:
+
+    python -m modules.bugs.manifest urls.txt manifest.jsonl --quality lossless
+
+An interrupted run continues where it stopped when it is started again with the same output file.
+"""
+import argparse
+import json
+import os
+import pickle
+import re
+from types import SimpleNamespace
+
+_url = re.compile(r'(?:https?://)?(?:m\.)?music\.bugs\.co\.kr/(track|album|artist)/(\d+)')
+
+
+def parse_url(url: str):
+    # ('track' | 'album' | 'artist', id) or None if it is not a Bugs! track, album or artist url
+    match = _url.search(url.strip())
+    return (match.group(1), int(match.group(2))) if match else None
+
+
+class ManifestWriter:
+    # appends the track lines to a JSONL file. Finished sources ("album:123") are listed in "<file>.checkpoint"
+    # after their lines were written, so a restarted job skips them and does not repeat lines of unfinished ones
+    def __init__(self, path: str):
+        self.path = path
+        self.checkpoint_path = f'{path}.checkpoint'
+
+        self.done = set()
+        if os.path.isfile(self.checkpoint_path):
+            with open(self.checkpoint_path, encoding='utf-8') as f:
+                self.done = {line.strip() for line in f if line.strip()}
+
+        # (source, track_id) of all lines which are already in the manifest
+        self.written = set()
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a crashed run can be incomplete
+                        continue
+                    self.written.add((entry.get('source'), entry.get('track_id')))
+
+        self._file = open(path, 'a', encoding='utf-8')
+        self._checkpoint = open(self.checkpoint_path, 'a', encoding='utf-8')
+
+    def write(self, entries: list):
+        for entry in entries:
+            key = (entry.get('source'), entry.get('track_id'))
+            if key in self.written:
+                continue
+            self.written.add(key)
+            self._file.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._file.flush()
+
+    def complete(self, sources: list):
+        # the lines must be on disk before their sources are marked as done
+        os.fsync(self._file.fileno())
+        for source in sources:
+            self.done.add(source)
+            self._checkpoint.write(source + '\n')
+        self._checkpoint.flush()
+        os.fsync(self._checkpoint.fileno())
+
+    def close(self):
+        self._file.close()
+        self._checkpoint.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PickleSettings:
+    # temporary settings (session tokens, account rights) of the command line tool, stored like OrpheusDL does
+    def __init__(self, path: str):
+        self.path = path
+        self.values = {}
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                self.values = pickle.load(f)
+
+    def read(self, key: str):
+        return self.values.get(key)
+
+    def set(self, key: str, value):
+        self.values[key] = value
+        with open(self.path, 'wb') as f:
+            pickle.dump(self.values, f)
+
+
+class ManifestError(Exception):
+    pass
+
+
+def create_module(data_folder: str, settings: dict):
+    from .interface import ModuleInterface
+
+    os.makedirs(data_folder, exist_ok=True)
+    module_controller = SimpleNamespace(
+        module_settings=settings,
+        data_folder=data_folder,
+        temporary_settings_controller=PickleSettings(os.path.join(data_folder, 'session.pkl')),
+        module_error=ManifestError,
+        printer_controller=SimpleNamespace(oprint=print),
+        orpheus_options=SimpleNamespace(default_cover_options=SimpleNamespace(resolution=1400)),
+    )
+    return ModuleInterface(module_controller)
+
+
+def main():
+    from utils.models import QualityEnum
+
+    parser = argparse.ArgumentParser(description='Resolve Bugs! track, album and artist urls to a JSONL manifest')
+    parser.add_argument('input', help='text file with one url per line')
+    parser.add_argument('output', help='JSONL manifest, an existing file is continued')
+    parser.add_argument('--quality', default='lossless', choices=[q.name.lower() for q in QualityEnum])
+    parser.add_argument('--settings', default='config/settings.json', help='OrpheusDL settings with the Bugs! login')
+    parser.add_argument('--data-folder', default='config/bugs_manifest', help='session and metadata cache folder')
+    parser.add_argument('--batch-size', type=int, default=200, help='urls resolved per batch')
+    args = parser.parse_args()
+
+    settings = {}
+    if os.path.isfile(args.settings):
+        with open(args.settings, encoding='utf-8') as f:
+            settings = json.load(f).get('modules', {}).get('bugs', {})
+
+    module = create_module(args.data_folder, settings)
+    if not module.session.access_token:
+        module.login(settings.get('username'), settings.get('password'))
+
+    with open(args.input, encoding='utf-8') as f:
+        urls = [line.strip() for line in f if line.strip()]
+
+    counts = module.resolve_manifest(urls, args.output, QualityEnum[args.quality.upper()], batch_size=args.batch_size)
+    print(', '.join(f'{count} {name}' for name, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import logging
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from difflib import SequenceMatcher
+
+from .cache import SingleFlightLRU
+from .records import convert_duration_str_to_secs
+
+# "(feat. X)", "[Remastered]", "- 2011 Remaster" and similar additions which differ between services
+_brackets = re.compile(r'[(\[].*?[)\]]')
+_feat = re.compile(r'\s(feat|ft|featuring)\.?\s.*$')
+_remaster = re.compile(r'\s-\s.*(remaster|version|edit|mix).*$')
+_non_word = re.compile(r'[^\w\s]')
+_spaces = re.compile(r'\s+')
+
+
+def normalize(text: str) -> str:
+    if not text:
+        return ''
+
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = _remaster.sub('', text)
+    text = _brackets.sub(' ', text)
+    text = _feat.sub('', text)
+    text = _non_word.sub(' ', text)
+    return _spaces.sub(' ', text).strip()
+
+
+@dataclass
+class MatchResult:
+    # best Bugs track for one source TrackInfo, track_id is None if nothing reached min_confidence
+    source: object
+    track_id: int = None
+    confidence: float = 0.0
+    data: dict = None
+
+
+class TrackMatcher:
+    # matches TrackInfos from other services to Bugs tracks: every distinct query is only searched once, the
+    # candidates are scored by title, artists, duration and album year
+    weights = {'title': 0.45, 'artist': 0.3, 'duration': 0.15, 'year': 0.1}
+
+    def __init__(self, session, max_workers: int = 8, candidates: int = 10, cache_size: int = 10000):
+        self.session = session
+        self.max_workers = max_workers
+        self.candidates = candidates
+        self.queries = SingleFlightLRU(maxsize=cache_size)
+
+    @staticmethod
+    def query(track_info) -> str:
+        artist = track_info.artists[0] if track_info.artists else ''
+        return f'{normalize(track_info.name)} {normalize(artist)}'.strip()
+
+    def search(self, query: str) -> list:
+        return self.queries.get(query, lambda: list(self.session.iter_search(
+            query, 'track', page_size=self.candidates, limit=self.candidates)))
+
+    def score(self, track_info, candidate: dict) -> float:
+        scores = {'title': SequenceMatcher(None, normalize(track_info.name),
+                                           normalize(candidate.get('track_title'))).ratio()}
+
+        source_artists = {normalize(a) for a in track_info.artists or []}
+        candidate_artists = {normalize(a.get('artist_nm')) for a in candidate.get('artists') or []}
+        if source_artists and candidate_artists:
+            # best similarity of any artist pair, handles "IU" vs "IU (아이유)" and additional artists
+            scores['artist'] = max(SequenceMatcher(None, a, b).ratio()
+                                   for a in source_artists for b in candidate_artists)
+
+        if track_info.duration and candidate.get('len'):
+            difference = abs(track_info.duration - convert_duration_str_to_secs(candidate.get('len')))
+            # full score up to 2s difference, zero from 15s on
+            scores['duration'] = max(0.0, min(1.0, (15 - difference) / 13))
+
+        release_ymd = (candidate.get('album') or {}).get('release_ymd')
+        if track_info.release_year and release_ymd:
+            difference = abs(int(track_info.release_year) - int(release_ymd[:4]))
+            scores['year'] = 1.0 if difference == 0 else 0.5 if difference == 1 else 0.0
+
+        # missing fields do not count against a candidate
+        total_weight = sum(self.weights[k] for k in scores)
+        return sum(self.weights[k] * v for k, v in scores.items()) / total_weight
+
+    def rank(self, track_info, candidates: list) -> list:
+        # [(score, candidate)] sorted by the best score first
+        return sorted(((self.score(track_info, c), c) for c in candidates), key=lambda x: x[0], reverse=True)
+
+    def match(self, track_info, min_confidence: float = 0.0) -> MatchResult:
+        return self._best(track_info, self.search(self.query(track_info)), min_confidence)
+
+    def _best(self, track_info, candidates: list, min_confidence: float) -> MatchResult:
+        ranked = self.rank(track_info, candidates)
+        if not ranked or ranked[0][0] < min_confidence:
+            return MatchResult(source=track_info, confidence=ranked[0][0] if ranked else 0.0)
+
+        confidence, candidate = ranked[0]
+        return MatchResult(source=track_info, track_id=candidate.get('track_id'), confidence=confidence,
+                           data=candidate)
+
+    def match_many(self, track_infos: list, min_confidence: float = 0.0) -> list:
+        # the distinct queries are searched concurrently first, afterwards every TrackInfo is scored from those
+        # results, so queries evicted from the LRU in the meantime are not searched again. A failed search only leaves
+        # its TrackInfos unmatched
+        queries = list(dict.fromkeys(self.query(t) for t in track_infos))
+
+        def search(query):
+            try:
+                return self.search(query)
+            except Exception:
+                logging.exception(f'Bugs: search for "{query}" failed')
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # {query: candidates}, None if the search failed
+            results = dict(zip(queries, executor.map(search, queries)))
+
+        matches = []
+        for t in track_infos:
+            candidates = results[self.query(t)]
+            matches.append(MatchResult(source=t) if candidates is None else self._best(t, candidates, min_confidence))
+        return matches
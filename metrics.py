@@ -0,0 +1,185 @@
+import logging
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+
+class _Stats:
+    __slots__ = ('requests', 'errors', 'statuses', 'latency_buckets', 'latency_sum', 'request_bytes',
+                 'response_bytes', 'transfer_bytes', 'compression_saved_bytes', 'retries', 'cache_hits', 'not_modified',
+                 'not_modified_bytes')
+
+    def __init__(self, bucket_count: int):
+        self.requests = 0
+        self.errors = 0
+        self.statuses = Counter()
+        # one more bucket for +Inf
+        self.latency_buckets = [0] * (bucket_count + 1)
+        self.latency_sum = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        # compressed bytes on the wire
+        self.transfer_bytes = 0
+        # per request never negative, gzip makes some small bodies larger
+        self.compression_saved_bytes = 0
+        self.retries = 0
+        self.cache_hits = 0
+        # revalidated responses served from the cache and their size
+        self.not_modified = 0
+        self.not_modified_bytes = 0
+
+
+class Metrics:
+    # per endpoint and per multi invoke id request statistics of a BugsApi, callbacks get every single event
+    buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        # callback(event: dict) is called after every request and cache hit
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    def _get(self, kind: str, name: str) -> _Stats:
+        # must be called with self._lock held
+        stats = self._stats.get((kind, name))
+        if stats is None:
+            stats = self._stats[(kind, name)] = _Stats(len(self.buckets))
+        return stats
+
+    def record_request(self, endpoint: str, invoke_ids: list = None, method: str = None, status=None,
+                       latency: float = 0.0, request_bytes: int = 0, response_bytes: int = 0, retries: int = 0,
+                       transfer_bytes: int = None):
+        # status is the HTTP status code or None if the request failed without a response, transfer_bytes is the
+        # compressed size of the response body, the same as response_bytes if it was not compressed
+        if transfer_bytes is None:
+            transfer_bytes = response_bytes
+        bucket = bisect_left(self.buckets, latency)
+        with self._lock:
+            for kind, name in [('endpoint', endpoint)] + [('invoke', i) for i in invoke_ids or []]:
+                stats = self._get(kind, name)
+                stats.requests += 1
+                stats.statuses[str(status) if status else 'error'] += 1
+                if not status or status >= 400:
+                    stats.errors += 1
+                stats.latency_buckets[bucket] += 1
+                stats.latency_sum += latency
+                stats.retries += retries
+
+                # the bytes of a multi invoke request can not be split between the calls
+                if kind == 'endpoint':
+                    stats.request_bytes += request_bytes
+                    stats.response_bytes += response_bytes
+                    stats.transfer_bytes += transfer_bytes
+                    stats.compression_saved_bytes += max(0, response_bytes - transfer_bytes)
+
+        self._emit({'type': 'request', 'endpoint': endpoint, 'invoke_ids': invoke_ids, 'method': method,
+                    'status': status, 'latency': latency, 'request_bytes': request_bytes,
+                    'response_bytes': response_bytes, 'transfer_bytes': transfer_bytes, 'retries': retries})
+
+    def record_cache_hit(self, endpoint: str, invoke_ids: list = None):
+        with self._lock:
+            for kind, name in [('endpoint', endpoint)] + [('invoke', i) for i in invoke_ids or []]:
+                self._get(kind, name).cache_hits += 1
+
+        self._emit({'type': 'cache_hit', 'endpoint': endpoint, 'invoke_ids': invoke_ids})
+
+    def record_not_modified(self, endpoint: str, invoke_ids: list = None, size: int = 0):
+        # a revalidated response was served from the cache, size is the body which did not have to be transferred
+        with self._lock:
+            for kind, name in [('endpoint', endpoint)] + [('invoke', i) for i in invoke_ids or []]:
+                stats = self._get(kind, name)
+                stats.not_modified += 1
+                if kind == 'endpoint':
+                    stats.not_modified_bytes += size
+
+        self._emit({'type': 'not_modified', 'endpoint': endpoint, 'invoke_ids': invoke_ids, 'size': size})
+
+    def _emit(self, event: dict):
+        for callback in self._callbacks:
+            try:
+                callback(event)
+            except Exception:
+                logging.exception('Bugs: metrics callback failed')
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def snapshot(self) -> dict:
+        # {'endpoint': {name: {...}}, 'invoke': {name: {...}}}
+        snapshot = {'endpoint': {}, 'invoke': {}}
+        with self._lock:
+            for (kind, name), stats in self._stats.items():
+                cumulative, histogram = 0, {}
+                for le, count in zip([*self.buckets, '+Inf'], stats.latency_buckets):
+                    cumulative += count
+                    histogram[str(le)] = cumulative
+
+                snapshot[kind][name] = {
+                    'requests': stats.requests,
+                    'errors': stats.errors,
+                    'statuses': dict(stats.statuses),
+                    'latency_histogram': histogram,
+                    'latency_sum': stats.latency_sum,
+                    'request_bytes': stats.request_bytes,
+                    'response_bytes': stats.response_bytes,
+                    'transfer_bytes': stats.transfer_bytes,
+                    'retries': stats.retries,
+                    'cache_hits': stats.cache_hits,
+                    'not_modified': stats.not_modified,
+                    # by revalidation and by compression
+                    'bytes_saved': stats.not_modified_bytes + stats.compression_saved_bytes,
+                }
+
+        return snapshot
+
+    def prometheus(self, prefix: str = 'bugs') -> str:
+        # snapshot in the Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name: str, metric_type: str, description: str, samples: list):
+            lines.append(f'# HELP {prefix}_{name} {description}')
+            lines.append(f'# TYPE {prefix}_{name} {metric_type}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f'{prefix}_{name}{suffix}{{{label_text}}} {value}')
+
+        for kind in ('endpoint', 'invoke'):
+            items = snapshot[kind].items()
+            metric(f'{kind}_requests_total', 'counter', f'Requests per {kind} and status',
+                   [('', {kind: n, 'status': status}, count)
+                    for n, s in items for status, count in s['statuses'].items()])
+            metric(f'{kind}_request_duration_seconds', 'histogram', f'Request latency per {kind}',
+                   [sample for n, s in items for sample in [
+                       *[('_bucket', {kind: n, 'le': le}, count) for le, count in s['latency_histogram'].items()],
+                       ('_sum', {kind: n}, s['latency_sum']),
+                       ('_count', {kind: n}, s['requests'])]])
+            metric(f'{kind}_retries_total', 'counter', f'Retries taken per {kind}',
+                   [('', {kind: n}, s['retries']) for n, s in items])
+            metric(f'{kind}_cache_hits_total', 'counter', f'Responses served from the cache per {kind}',
+                   [('', {kind: n}, s['cache_hits']) for n, s in items])
+            metric(f'{kind}_not_modified_total', 'counter', f'Revalidated responses served from the cache per {kind}',
+                   [('', {kind: n}, s['not_modified']) for n, s in items])
+
+        items = snapshot['endpoint'].items()
+        metric('endpoint_request_bytes_total', 'counter', 'Request body bytes per endpoint',
+               [('', {'endpoint': n}, s['request_bytes']) for n, s in items])
+        metric('endpoint_response_bytes_total', 'counter', 'Response body bytes per endpoint',
+               [('', {'endpoint': n}, s['response_bytes']) for n, s in items])
+        metric('endpoint_transfer_bytes_total', 'counter', 'Compressed response body bytes per endpoint',
+               [('', {'endpoint': n}, s['transfer_bytes']) for n, s in items])
+        metric('endpoint_bytes_saved_total', 'counter', 'Bytes saved by revalidation and compression per endpoint',
+               [('', {'endpoint': n}, s['bytes_saved']) for n, s in items])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
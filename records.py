@@ -0,0 +1,71 @@
+def _shared(values: dict, value):
+    # returns an equal value which was already created before, so thousands of tracks share a few sets
+    return values.setdefault(value, value)
+
+
+_bitrates = {}
+
+
+def convert_duration_str_to_secs(duration: str) -> int:
+    # convert MM:SS (string) to seconds (int)
+    return sum(int(x) * 60 ** i for i, x in enumerate(reversed(duration.split(':'))))
+
+
+class TrackRecord:
+    # the fields of an API track which get_track_info, get_track_cover and the quality selection read, passed to the
+    # track jobs in the extra_kwargs instead of the whole API result
+    __slots__ = ('track_id', 'title', 'artists', 'album_id', 'album_image_path', 'streamable', 'flac_premium',
+                 'lossless', 'bitrates', 'len', 'track_no', 'disc_no', 'track_gain')
+
+    def __init__(self, track_id: int, title: str, artists: tuple, album_id: int, album_image_path: str,
+                 streamable: bool, flac_premium: bool, lossless: bool, bitrates: frozenset, len: str,
+                 track_no: int = None, disc_no: int = None, track_gain: float = None):
+        self.track_id = track_id
+        self.title = title
+        # ((artist_id, artist_nm), ...)
+        self.artists = artists
+        self.album_id = album_id
+        self.album_image_path = album_image_path
+        self.streamable = streamable
+        # "Premium" is required to stream the flac file
+        self.flac_premium = flac_premium
+        self.lossless = lossless
+        self.bitrates = bitrates
+        self.len = len
+        self.track_no = track_no
+        self.disc_no = disc_no
+        self.track_gain = track_gain
+
+    @classmethod
+    def from_api(cls, track):
+        # projects an API track result, records are returned unchanged
+        if isinstance(track, cls):
+            return track
+
+        rights = track.get('rights') or {}
+        streaming = rights.get('streaming') or {}
+        album = track.get('album') or {}
+
+        return cls(
+            track_id=track.get('track_id'),
+            title=track.get('track_title'),
+            artists=tuple((a.get('artist_id'), a.get('artist_nm')) for a in track.get('artists') or []),
+            album_id=album.get('album_id'),
+            album_image_path=(album.get('image') or {}).get('path'),
+            streamable=bool(streaming.get('service_yn')),
+            flac_premium=bool(streaming.get('flac_premium_yn')),
+            lossless=bool((rights.get('download_flac') or {}).get('service_flac_yn')),
+            bitrates=_shared(_bitrates, frozenset(track.get('bitrates') or ())),
+            len=track.get('len'),
+            track_no=track.get('track_no'),
+            disc_no=track.get('disc_no'),
+            track_gain=track.get('track_gain'),
+        )
+
+    @property
+    def artist_names(self) -> list:
+        return [name for _, name in self.artists]
+
+    @property
+    def artist_id(self):
+        return self.artists[0][0] if self.artists else None
@@ -0,0 +1,115 @@
+import threading
+import time
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+class AdaptiveRateLimiter:
+    # token bucket shared by all threads of a client: a 429 halves the rate (at most once per decrease_interval) and
+    # pauses all requests until the Retry-After time, every successful request increases the rate by 5% again
+    def __init__(self, rate: float = 50.0, burst: int = 50, min_rate: float = 2.0, max_rate: float = 200.0,
+                 increase: float = 0.05, decrease: float = 0.5, decrease_interval: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        # 429s of requests which were already in flight only decrease the rate once
+        self.decrease_interval = decrease_interval
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+
+    def acquire(self):
+        # blocks until a request may be sent
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate * (1 + self.increase))
+
+    def on_throttled(self, retry_after: float = None):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.decrease_interval:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._last_decrease = now
+
+            self._tokens = 0.0
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+
+
+class CircuitBreaker:
+    # opens after failure_threshold consecutive failures and lets requests fail fast for reset_timeout seconds, then
+    # a single trial request decides if it closes again
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return 'open'
+            return 'half-open'
+
+    def before_request(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+
+            if time.monotonic() - self._opened_at >= self.reset_timeout and not self._trial_running:
+                # half-open: let one request through
+                self._trial_running = True
+                return
+
+        raise CircuitOpenError('Bugs API is currently unavailable, requests are paused')
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+def parse_retry_after(value: str):
+    # only the seconds format of the Retry-After header is used by the API
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,152 @@
+import codecs
+import json
+import re
+
+# the next character which can change the structure outside of strings, and the end of a string or an escape
+_structural = re.compile(r'["\[\]{},:]')
+_string_end = re.compile(r'["\\]')
+_whitespace = re.compile(r'\s*')
+_delimiters = ' \t\r\n,]'
+
+_decoder = json.JSONDecoder()
+
+
+class _Container:
+    __slots__ = ('is_object', 'path', 'index', 'key', 'expect_key', 'on_path', 'is_target')
+
+    def __init__(self, is_object: bool, path: tuple, target: tuple):
+        self.is_object = is_object
+        self.path = path
+        self.index = 0
+        self.key = None
+        self.expect_key = is_object
+        matches = all(t is None or t == p for p, t in zip(path, target))
+        # only the keys of containers on the way to the target array are needed
+        self.on_path = matches and len(path) < len(target)
+        self.is_target = matches and not is_object and len(path) == len(target)
+
+
+def iter_list_items(chunks, path: tuple):
+    # yields the decoded items of the array at path while the JSON document is still arriving in byte chunks. path
+    # contains the object keys and array indices from the root, None matches every index, e.g.
+    # ('list', 0, 'artist_track', 'list') for the items of the first call of a multi invoke response. Only one item
+    # at a time is decoded, everything outside of the target array is skipped without building any objects
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    state = _ScanState(path)
+
+    for chunk in chunks:
+        if chunk:
+            yield from state.feed(text_decoder.decode(chunk), final=False)
+    yield from state.feed(text_decoder.decode(b'', final=True), final=True)
+
+    if state.stack:
+        raise ValueError('Incomplete JSON document')
+
+
+class _ScanState:
+    def __init__(self, path: tuple):
+        self.path = path
+        self.buffer = ''
+        # position in buffer up to which the text was scanned
+        self.position = 0
+        self.stack = []
+        self.in_string = False
+        # start of an unfinished key
+        self.key_start = None
+
+    def feed(self, text: str, final: bool):
+        keep = self.position if self.key_start is None else self.key_start
+        self.buffer = self.buffer[keep:] + text
+        self.position -= keep
+        if self.key_start is not None:
+            self.key_start -= keep
+
+        buffer = self.buffer
+        while True:
+            top = self.stack[-1] if self.stack else None
+
+            if top is not None and top.is_target:
+                # the items themselves are decoded by the C decoder, one complete item at a time
+                position = _whitespace.match(buffer, self.position).end()
+                if position >= len(buffer):
+                    self.position = position
+                    return
+
+                char = buffer[position]
+                if char == ',':
+                    self.position = position + 1
+                    continue
+                if char == ']':
+                    self.position = position + 1
+                    self.stack.pop()
+                    continue
+
+                try:
+                    item, end = _decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    # the item is not complete yet
+                    self.position = position
+                    return
+
+                # a number like "-1." can continue in the next chunk, an item is only complete before a delimiter
+                if not final and (end >= len(buffer) or buffer[end] not in _delimiters):
+                    self.position = position
+                    return
+
+                self.position = end
+                yield item
+                continue
+
+            if self.in_string:
+                match = _string_end.search(buffer, self.position)
+                if match is None:
+                    self.position = len(buffer)
+                    return
+                if match.group() == '\\':
+                    # skip the escaped character, it can be in the next chunk
+                    if match.end() >= len(buffer):
+                        self.position = match.start()
+                        return
+                    self.position = match.end() + 1
+                    continue
+
+                self.in_string = False
+                self.position = match.end()
+                if self.key_start is not None:
+                    top.key = json.loads(buffer[self.key_start:self.position])
+                    self.key_start = None
+                continue
+
+            match = _structural.search(buffer, self.position)
+            if match is None:
+                self.position = len(buffer)
+                return
+
+            char = match.group()
+            self.position = match.end()
+
+            if char == '"':
+                self.in_string = True
+                if top is not None and top.on_path and top.is_object and top.expect_key:
+                    self.key_start = match.start()
+            elif char in '{[':
+                if top is None:
+                    child_path = ()
+                elif top.on_path:
+                    child_path = top.path + (top.key if top.is_object else top.index,)
+                else:
+                    # somewhere outside of the target path, nothing in it is needed
+                    child_path = None
+                self.stack.append(_Container(char == '{', child_path, self.path) if child_path is not None
+                                  else _Container(char == '{', (None,) * (len(self.path) + 1), ()))
+            elif char == ':':
+                top.expect_key = False
+            elif char == ',':
+                if top.is_object:
+                    top.expect_key = True
+                else:
+                    top.index += 1
+            else:
+                self.stack.pop()
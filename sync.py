@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .bugs_api import BugsApi
+
+
+class WatermarkStore:
+    # the newest known album ids and release date of every synced artist listing, persisted in SQLite
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS watermarks ('
+                         'artist_id INTEGER NOT NULL, '
+                         'listing TEXT NOT NULL, '
+                         'album_ids TEXT NOT NULL, '
+                         'release_ymd TEXT, '
+                         'synced REAL NOT NULL, '
+                         'PRIMARY KEY (artist_id, listing))')
+
+    def get(self, artist_id: int, listing: str):
+        # (album_ids, release_ymd) or None if the listing was never synced
+        with self._lock:
+            row = self._db.execute('SELECT album_ids, release_ymd FROM watermarks WHERE artist_id = ? AND listing = ?',
+                                   (artist_id, listing)).fetchone()
+
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def set(self, artist_id: int, listing: str, album_ids: list, release_ymd: str = None):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO watermarks (artist_id, listing, album_ids, release_ymd, synced) '
+                             'VALUES (?, ?, ?, ?, ?)', (artist_id, listing, json.dumps(album_ids), release_ymd,
+                                                        time.time()))
+
+    def remove(self, artist_id: int):
+        with self._lock:
+            self._db.execute('DELETE FROM watermarks WHERE artist_id = ?', (artist_id,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ArtistSync:
+    # fetches only the releases which are newer than the watermark of an artist: the album listings are sorted by
+    # "recent", so paging stops at the first known album, usually after the first small page
+    listings = {
+        'albums': (BugsApi.artist_albums_calls, 'artist_album_filter_release'),
+        'compilations': (BugsApi.artist_compilation_albums_calls, 'artist_album_filter_joincompil'),
+    }
+
+    def __init__(self, api: BugsApi, store: WatermarkStore, page_size: int = 20, watermark_size: int = 50,
+                 max_workers: int = 8):
+        self.api = api
+        self.store = store
+        self.page_size = page_size
+        # number of newest album ids kept per listing, a few known ids are enough to find the position again
+        self.watermark_size = watermark_size
+        self.max_workers = max_workers
+
+    def _new_albums(self, artist_id: int, listing: str, watermark, baseline: bool) -> list:
+        calls_builder, invoke_id = self.listings[listing]
+        known_ids = set(watermark[0]) if watermark else set()
+        newest = watermark[1] if watermark else None
+
+        albums, page = [], 1
+        while True:
+            # the listings are cached for hours, a sync always needs the current state
+            result = self.api.invoke(calls_builder(artist_id, page, self.page_size), use_cache=False)
+            items = (result[0].get(invoke_id) or {}).get('list') or [] if result else []
+
+            for album in items:
+                if album.get('album_id') in known_ids:
+                    return albums
+                # fallback if none of the known albums is listed anymore, e.g. they were removed
+                if newest and album.get('release_ymd') and album.get('release_ymd') < newest:
+                    return albums
+                albums.append(album)
+
+            # the first sync of a baseline only needs the newest page for the watermark
+            if len(items) < self.page_size or (watermark is None and baseline):
+                return albums
+            page += 1
+
+    def sync(self, artist_id: str or int, include_compilations: bool = False, include_tracks: bool = True,
+             baseline: bool = True) -> dict:
+        # returns {'albums': [new albums], 'tracks': [tracks of the new albums]}, newest first. The first sync of an
+        # artist only records the watermark and returns nothing, unless baseline is False, then the whole
+        # discography is returned as new
+        artist_id = int(artist_id)
+        listings = ['albums', 'compilations'] if include_compilations else ['albums']
+
+        new_albums, watermarks = [], {}
+        for listing in listings:
+            watermark = self.store.get(artist_id, listing)
+            albums = self._new_albums(artist_id, listing, watermark, baseline)
+            watermarks[listing] = self._next_watermark(watermark, albums)
+            if watermark is not None or not baseline:
+                new_albums += albums
+
+        # the same album can be listed as release and compilation
+        new_albums = list({a.get('album_id'): a for a in new_albums}.values())
+
+        tracks = []
+        if include_tracks and new_albums:
+            album_tracks = self.api.get_albums_tracks([a.get('album_id') for a in new_albums])
+            for album in new_albums:
+                tracks += album_tracks[album.get('album_id')][0].get('album_track').get('list') or []
+
+        # only move the watermarks when everything was fetched, otherwise the next sync returns the albums again
+        for listing, (album_ids, release_ymd) in watermarks.items():
+            self.store.set(artist_id, listing, album_ids, release_ymd)
+
+        return {'albums': new_albums, 'tracks': tracks}
+
+    def _next_watermark(self, watermark, new_albums: list) -> tuple:
+        album_ids = [a.get('album_id') for a in new_albums] + (watermark[0] if watermark else [])
+        release_dates = [a.get('release_ymd') for a in new_albums if a.get('release_ymd')]
+        if watermark and watermark[1]:
+            release_dates.append(watermark[1])
+        return list(dict.fromkeys(album_ids))[:self.watermark_size], max(release_dates, default=None)
+
+    def sync_many(self, artist_ids: list, **kwargs) -> dict:
+        # syncs many artists concurrently, returns {artist_id: sync() result}. Failed artists are logged and left out,
+        # their watermark is unchanged so the next sync catches up
+        artist_ids = list(dict.fromkeys(int(i) for i in artist_ids))
+        results = {}
+
+        def sync(artist_id):
+            try:
+                results[artist_id] = self.sync(artist_id, **kwargs)
+            except Exception:
+                logging.exception(f'Bugs: sync of artist {artist_id} failed')
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(sync, artist_ids))
+
+        return {i: results[i] for i in artist_ids if i in results}